@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+"""Time mtgtool.py's deck file parser on generated deck files of growing size.
+
+Per size, both deck file formats are generated, with card names repeating
+so counts get summed up. The parser is timed in this process, without the
+start-up of a mtgtool.py run. It should scale linearly, so the time per line
+should stay about the same from the smallest to the largest file.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import mtgtool  # noqa: E402
+
+
+def write_deck_file(path, n_lines, deck_format):
+    # About one distinct card name per ten lines.
+    rand = random.Random(n_lines)
+    n_names = max(n_lines // 10, 1)
+    with open(path, 'w') as f:
+        for i in range(n_lines):
+            if deck_format == 2 and i == n_lines * 3 // 4:
+                f.write('Sideboard\n')
+            elif i % 50 == 0:
+                f.write('// comment\n')
+            else:
+                line = '%d Card Name %d\n' % (rand.randint(1, 4),
+                                              rand.randrange(n_names))
+                if deck_format == 1 and i > n_lines * 3 // 4:
+                    line = 'SB: ' + line
+                f.write(line)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for deck_format in (1, 2):
+            for n_lines in sizes:
+                path = os.path.join(tmp_dir, 'deck_%d_%d' % (deck_format,
+                                                             n_lines))
+                write_deck_file(path, n_lines, deck_format)
+                start = time.perf_counter()
+                entry_list, _ = mtgtool.parse_deck_file(path)
+                seconds = time.perf_counter() - start
+                if entry_list is None:
+                    sys.exit('Generated deck file failed to parse: ' + path)
+                print('format %d, %7d lines: %6.3f s, %8.0f lines/second' %
+                      (deck_format, n_lines, seconds, n_lines / seconds))
+
+
+main()
@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+"""Time the hot paths of mtgtool.py on generated card data, offline.
+
+Card data shaped like mtgjson's AllSets-x.json (sets of cards with split
+cards, reprints, rulings, foreign names and legalities) and a deck file of
+its card names are generated, and a card DB is built from them in a
+temporary home directory, without any download. Then DB builds, card
+lookups on a freshly opened DB (cold) and on one already used (warm),
+translated name lookups, template rendering, deck file parsing and deck
+browser redraws (against a fake curses screen) are timed.
+
+Timings are the best of --repeat runs, in seconds per operation, written as
+JSON to --output along with the settings used. With --baseline, they are
+compared to those of an earlier run's output, and the run fails if any of
+them is slower by more than --threshold.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import mtgtool  # noqa: E402
+
+words = ['Ancient', 'Angel', 'Blade', 'Cinder', 'Crab', 'Dragon', 'Elf',
+         'Engine', 'Fire', 'Glade', 'Goblin', 'Growth', 'Knight', 'Lightning',
+         'Militia', 'Reap', 'Shadow', 'Spirit', 'Storm', 'Wurm']
+languages = ['German', 'French', 'Italian', 'Spanish', 'Portuguese (Brazil)',
+             'Japanese', 'Chinese Simplified', 'Russian', 'Korean']
+formats = ['Commander', 'Legacy', 'Modern', 'Vintage']
+colors = ['White', 'Blue', 'Black', 'Red', 'Green']
+full_template = """%name% (%names|comma%)
+%mana_cost% %converted_mana_cost% %current_type% %printed_type%
+%power%/%toughness% %max_hand_size_mod% %start_life_total_mod% %rarity%
+%color|comma% %color_identity|comma% %supertypes|comma% %types|comma%
+%subtypes|comma% %sets|comma%
+%oracle_text|indent%
+%printed_text|indent%
+%flavor|indent%
+%rulings|indent%
+%legalities|indent%
+%foreign_names|indent%"""
+
+
+def generate_sets(settings):
+    # Every tenth card of a set after the first is a reprint of a card of an
+    # earlier set, so card names come with several printings.
+    rand = random.Random(1)
+    sets = {}
+    names = []
+    printings = {}
+    for i in range(settings.sets):
+        set_name = 'S%03d' % i
+        cards = []
+        for j in range(settings.cards):
+            if names and j % 10 == 9:
+                name = rand.choice(names)
+            else:
+                name = '%s %s %d' % (rand.choice(words), rand.choice(words),
+                                     i * settings.cards + j)
+            if settings.split_every and j % settings.split_every == 0:
+                halves = [name + ' Left', name + ' Right']
+                cards += [dict(make_card(rand, settings, set_name, half, j),
+                               layout='split', names=halves,
+                               imageName=halves[0].lower())
+                          for half in halves]
+            else:
+                cards += [make_card(rand, settings, set_name, name, j)]
+                if name not in printings:
+                    names += [name]
+                    printings[name] = []
+                if set_name not in printings[name]:
+                    printings[name] += [set_name]
+        sets[set_name] = {'name': 'Set ' + set_name, 'code': set_name,
+                          'releaseDate': '%04d-%02d-01' % (2000 + i // 12,
+                                                           i % 12 + 1),
+                          'type': 'expansion', 'cards': cards}
+    for mtgjson_set in sets.values():
+        for card in mtgjson_set['cards']:
+            card['printings'] = printings.get(card['name'],
+                                              [mtgjson_set['code']])
+    return sets
+
+
+def make_card(rand, settings, set_name, name, number):
+    cmc = rand.randrange(8)
+    return {
+        'id': hashlib.sha1((set_name + name + str(number)).encode())
+        .hexdigest(),
+        'layout': 'normal', 'name': name, 'manaCost': '{%d}' % cmc,
+        'cmc': cmc, 'type': 'Creature — ' + rand.choice(words),
+        'originalType': 'Creature — ' + rand.choice(words),
+        'types': ['Creature'], 'subtypes': [rand.choice(words)],
+        'colors': [rand.choice(colors)],
+        'rarity': rand.choice(['Common', 'Uncommon', 'Rare']),
+        'text': ' '.join(rand.choice(words) for _ in range(30)),
+        'originalText': ' '.join(rand.choice(words) for _ in range(30)),
+        'flavor': ' '.join(rand.choice(words) for _ in range(12)),
+        'power': str(rand.randrange(6)), 'toughness': str(rand.randrange(6)),
+        'legalities': [{'format': format_name, 'legality': 'Legal'}
+                       for format_name in formats],
+        'rulings': [{'date': '2010-01-01',
+                     'text': ' '.join(rand.choice(words) for _ in range(20))}
+                    for _ in range(rand.randint(0, settings.rulings))],
+        'foreignNames': [{'language': language, 'name': name + ' ' +
+                          language[:2]}
+                         for language in languages[:settings.foreign_names]],
+        'imageName': name.lower()}
+
+
+def write_deck_file(path, names, n_lines):
+    rand = random.Random(n_lines)
+    with open(path, 'w') as f:
+        for i in range(n_lines):
+            if i == n_lines * 3 // 4:
+                f.write('Sideboard\n')
+            f.write('%d %s\n' % (rand.randint(1, 4), rand.choice(names)))
+
+
+class FakeWindow:
+    # Takes all curses window calls without drawing anything.
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class FakeScreen(FakeWindow):
+
+    def __init__(self, keys):
+        self._keys = iter(keys)
+
+    def getch(self):
+        return ord(next(self._keys))
+
+
+def make_fake_curses():
+    fake_curses = types.ModuleType('curses')
+    fake_curses.LINES = 50
+    fake_curses.COLS = 120
+    fake_curses.A_NORMAL = 0
+    fake_curses.A_REVERSE = 1
+    fake_curses.KEY_RESIZE = 410
+    fake_curses.newwin = lambda *args: FakeWindow()
+    fake_curses.newpad = lambda *args: FakeWindow()
+    for name in ('curs_set', 'doupdate', 'flushinp', 'resizeterm'):
+        setattr(fake_curses, name, lambda *args: None)
+    return fake_curses
+
+
+def best_time(repeat, n_ops, run):
+    # Best of repeat runs, per operation.
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times += [(time.perf_counter() - start) / n_ops]
+    return min(times)
+
+
+def run_benchmarks(settings, home):
+    rand = random.Random(2)
+    sets = generate_sets(settings)
+    archive = os.path.join(home, 'AllSets-x.json.zip')
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('AllSets-x.json', json.dumps(sets))
+    names = sorted({card['name'] for mtgjson_set in sets.values()
+                    for card in mtgjson_set['cards']})
+    foreign_names = sorted({foreign_name['name']
+                            for mtgjson_set in sets.values()
+                            for card in mtgjson_set['cards']
+                            for foreign_name in card['foreignNames']})
+    lookup_names = [rand.choice(names) for _ in range(settings.lookups)]
+    lookup_foreign_names = [rand.choice(foreign_names)
+                            for _ in range(settings.lookups)] \
+        if foreign_names else []
+    deck_path = os.path.join(home, 'deck.txt')
+    write_deck_file(deck_path, names, settings.deck_lines)
+    os.environ['HOME'] = home
+    mtgtool.args = argparse.Namespace(quiet=True)
+    mtgtool.mtgjson_url = 'file://' + archive
+    seconds = {}
+
+    def build_db():
+        mtgtool.DB(rebuild=True,
+                   build_workers=settings.build_workers).conn.close()
+
+    seconds['build_db'] = best_time(settings.repeat, 1, build_db)
+
+    def get_card_cold():
+        for name in lookup_names:
+            db = mtgtool.DB()
+            mtgtool.get_card(db.cursor, name)
+            db.conn.close()
+
+    seconds['get_card_cold'] = best_time(settings.repeat, len(lookup_names),
+                                         get_card_cold)
+    db = mtgtool.DB()
+
+    def lookup(function, *args):
+        return lambda: [function(db.cursor, name, *args)
+                        for name in lookup_names]
+
+    lookup(mtgtool.get_card)()
+    seconds['get_card_warm'] = best_time(settings.repeat, len(lookup_names),
+                                         lookup(mtgtool.get_card))
+    if lookup_foreign_names:
+        seconds['get_translated_original_name'] = best_time(
+            settings.repeat, len(lookup_foreign_names),
+            lambda: [mtgtool.get_translated_original_name(db.cursor, name)
+                     for name in lookup_foreign_names])
+
+    def render_template():
+        mtgtool.compiled_templates.clear()
+        for name in lookup_names:
+            mtgtool.get_card(db.cursor, name, templ=full_template)
+
+    seconds['render_template'] = best_time(settings.repeat,
+                                           len(lookup_names), render_template)
+    seconds['parse_deck_file'] = best_time(
+        settings.repeat, 1, lambda: mtgtool.parse_deck_file(deck_path))
+    entry_list, has_sideboard = mtgtool.parse_deck_file(deck_path)
+    keys = 's' * settings.redraws + 'jk' * 5 + 'w' * settings.redraws + 'q'
+    # browse_cards() draws with the curses module imported by the CLI code.
+    mtgtool.curses = make_fake_curses()
+
+    def browse():
+        mtgtool.browse_cards(FakeScreen(keys), db, list(entry_list),
+                             has_sideboard)
+
+    seconds['browser_redraw'] = best_time(settings.repeat, len(keys), browse)
+    db.conn.close()
+    return seconds
+
+
+def compare(seconds, baseline, threshold):
+    # Returns whether no timing is slower than its baseline by more than
+    # threshold.
+    is_good = True
+    for name in seconds:
+        line = '%-30s %10.6f s' % (name, seconds[name])
+        if name in baseline:
+            change = seconds[name] / baseline[name] - 1
+            line += '  %+7.1f%% vs. %10.6f s' % (100 * change, baseline[name])
+            if change > threshold:
+                line += '  SLOWER'
+                is_good = False
+        print(line)
+    return is_good
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time mtgtool.py on '
+                                     'generated card data.')
+    parser.add_argument('--sets', type=int, default=40,
+                        help='number of sets (default: 40)')
+    parser.add_argument('--cards', type=int, default=250,
+                        help='cards per set (default: 250)')
+    parser.add_argument('--split-every', type=int, default=25,
+                        help='make every Nth card a split card, 0 for none '
+                        '(default: 25)')
+    parser.add_argument('--rulings', type=int, default=3,
+                        help='maximum rulings per card (default: 3)')
+    parser.add_argument('--foreign-names', type=int, default=4,
+                        help='foreign names per card, up to %d (default: 4)'
+                        % len(languages))
+    parser.add_argument('--deck-lines', type=int, default=1000,
+                        help='lines of the deck file (default: 1000)')
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='card lookups per run (default: 200)')
+    parser.add_argument('--redraws', type=int, default=100,
+                        help='deck browser moves down and up again per run '
+                        '(default: 100)')
+    parser.add_argument('--build-workers', type=int, default=1,
+                        help='worker processes of DB builds (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best one counts '
+                        '(default: 3)')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='JSON file to write timings to (default: '
+                        'benchmark_results.json)')
+    parser.add_argument('--baseline',
+                        help='JSON file of earlier timings to compare to')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fail if a timing is slower than its baseline '
+                        'by more than this fraction (default: 0.25)')
+    settings = parser.parse_args()
+    with tempfile.TemporaryDirectory() as home:
+        seconds = run_benchmarks(settings, home)
+    benchmark_settings = {key: value for key, value in vars(settings).items()
+                          if key not in ('output', 'baseline', 'threshold')}
+    with open(settings.output, 'w') as f:
+        json.dump({'settings': benchmark_settings, 'seconds': seconds}, f,
+                  indent=2)
+    baseline = {}
+    if settings.baseline:
+        with open(settings.baseline) as f:
+            baseline_results = json.load(f)
+        if baseline_results['settings'] != benchmark_settings:
+            print('Warning: baseline was taken with other settings:',
+                  baseline_results['settings'])
+        baseline = baseline_results['seconds']
+    if not compare(seconds, baseline, settings.threshold):
+        sys.exit(1)
+
+
+main()
@@ -37,6 +37,251 @@ LEGALITIES:
 FOREIGN NAMES:
 %foreign_names|indent%"""
 
+# Settings trading crash safety for speed while DB writes go to a shadow copy
+# of the DB; connections to the live DB keep sqlite's safe defaults.
+build_pragmas = {'journal_mode': 'MEMORY', 'synchronous': 'OFF',
+                 'cache_size': -65536, 'temp_store': 'MEMORY'}
+insert_batch_size = 10000
+render_cache_size = 64 << 20
+compiled_templates = {}
+
+# One row per card of all its data as print_card() needs it, with lists stored
+# as JSON arrays, so a card's data can be read with a single query.
+card_record_lists = [('names', 'multinames', 'name'),
+                     ('color', 'colors', 'color'),
+                     ('color_identity', 'color_identities', 'color_identity'),
+                     ('supertypes', 'supertypes', 'supertype'),
+                     ('types', 'types', 'type'),
+                     ('subtypes', 'subtypes', 'subtype'),
+                     ('sets', 'sets', 'set_name'),
+                     ('rulings', 'rulings', "date || ': ' || text"),
+                     ('legalities', 'legalities',
+                      "format || ': ' || legality"),
+                     ('foreign_names', 'foreign_names',
+                      "language || ': ' || name")]
+card_record_list_fields = [field for field, _, _ in card_record_lists]
+card_records_query = \
+    'INSERT OR REPLACE INTO card_records SELECT id, name, layout, ' \
+    'mana_cost, cmc, oracle_type, original_type, power, toughness, hand, ' \
+    'life, flavor, oracle_text, original_text, rarity, ' + \
+    ', '.join(['(SELECT json_group_array(' + expression + ') FROM '
+               '(SELECT * FROM card_' + table + ' WHERE id = cards.id '
+               'ORDER BY rowid))'
+               for _, table, expression in card_record_lists]) + \
+    ' FROM cards'
+
+# Per card name, its printings in release order (each with the card's first
+# row in that set), and the default printing from the newest set. Sets of
+# the same release date count in their order in the card data. The
+# placeholder takes an extra condition on cards c to only refresh some names.
+card_printings_query = \
+    'INSERT INTO card_printings SELECT name, set_name, id, use_multinames, ' \
+    'row_number() OVER (PARTITION BY name ORDER BY date, set_position) ' \
+    'FROM (SELECT c.name, c.set_name, c.id, c.use_multinames, s.date, ' \
+    's.position AS set_position, row_number() OVER (PARTITION BY c.name, ' \
+    'c.set_name ORDER BY c.rowid) AS set_row ' \
+    'FROM cards c JOIN sets s ON s.name = c.set_name {}) WHERE set_row = 1'
+card_defaults_query = \
+    'INSERT INTO card_defaults SELECT p.name, p.set_name, p.id, ' \
+    'p.use_multinames, counts.card_count FROM card_printings p JOIN ' \
+    '(SELECT c.name, count(*) AS card_count, max(p.position) AS position ' \
+    'FROM cards c JOIN card_printings p ON p.name = c.name AND ' \
+    'p.set_name = c.set_name {} GROUP BY c.name) counts ' \
+    'ON p.name = counts.name AND p.position = counts.position'
+
+# Distinct card names with their normalize_name() forms, for tolerant name
+# search; a trigram full-text index over the normalized forms finds similar
+# names.
+card_names_query = \
+    'INSERT INTO card_names (name, norm_name) ' \
+    'SELECT DISTINCT name, normalize_name(name) FROM cards c {}'
+
+# Compact read-only index of all card names, written next to the DB with each
+# build of it, so that name lookups need not open the DB: a header naming the
+# DB build it belongs to, one offset per record plus the end offset, then the
+# records, sorted by normalized name, of normalized name, name and default
+# printing id separated by NUL bytes. The placeholder of the query of its
+# records takes a condition on card_names n.
+name_index_format = '=8sII64s'
+name_index_magic = b'MTGNAMES'
+name_index_version = 1
+name_index_query = \
+    'SELECT n.norm_name, n.name, d.id FROM card_names n ' \
+    'JOIN card_defaults d ON d.name = n.name {} ORDER BY n.norm_name, n.name'
+
+# Schema upgrades applied in order by DB.migrate(), both to existing DBs and
+# to freshly created ones once all card data is inserted; the number of
+# upgrades applied is stored as the DB's PRAGMA user_version.
+migrations = [
+    ['CREATE INDEX cards_name ON cards (name)',
+     'CREATE INDEX card_multinames_id ON card_multinames (id)',
+     'CREATE INDEX card_sets_id ON card_sets (id)',
+     'CREATE INDEX card_colors_id ON card_colors (id)',
+     'CREATE INDEX card_color_identities_id ON card_color_identities (id)',
+     'CREATE INDEX card_supertypes_id ON card_supertypes (id)',
+     'CREATE INDEX card_types_id ON card_types (id)',
+     'CREATE INDEX card_subtypes_id ON card_subtypes (id)',
+     'CREATE INDEX card_rulings_id ON card_rulings (id)',
+     'CREATE INDEX card_foreign_names_id ON card_foreign_names (id)',
+     'CREATE INDEX card_legalities_id ON card_legalities (id)',
+     'CREATE INDEX card_foreign_names_name ON card_foreign_names (name)'],
+    ['ALTER TABLE sets ADD COLUMN card_count INTEGER',
+     'ALTER TABLE sets ADD COLUMN content_hash TEXT',
+     'CREATE INDEX cards_set_name ON cards (set_name)'],
+    ['CREATE TABLE card_records ('
+     'id PRIMARY KEY UNIQUE, '
+     'name, '
+     'layout, '
+     'mana_cost, '
+     'converted_mana_cost, '
+     'current_type, '
+     'printed_type, '
+     'power, '
+     'toughness, '
+     'max_hand_size_mod, '
+     'start_life_total_mod, '
+     'flavor, '
+     'oracle_text, '
+     'printed_text, '
+     'rarity, ' +
+     ', '.join(card_record_list_fields) + ', '
+     'FOREIGN KEY(id) REFERENCES cards(id))',
+     card_records_query],
+    ['CREATE TABLE card_printings ('
+     'name, '
+     'set_name, '
+     'id, '
+     'use_multinames, '
+     'position, '
+     'FOREIGN KEY(id) REFERENCES cards(id))',
+     'CREATE TABLE card_defaults ('
+     'name PRIMARY KEY UNIQUE, '
+     'set_name, '
+     'id, '
+     'use_multinames, '
+     'card_count, '
+     'FOREIGN KEY(id) REFERENCES cards(id))',
+     'CREATE INDEX card_printings_name ON card_printings (name, set_name)'],
+    ['CREATE TABLE card_names ('
+     'name PRIMARY KEY UNIQUE, '
+     'norm_name)',
+     card_names_query.format(''),
+     'CREATE INDEX card_names_norm_name ON card_names (norm_name)',
+     'CREATE VIRTUAL TABLE card_name_trigrams USING fts5(norm_name, '
+     'content=card_names, tokenize=trigram)',
+     'INSERT INTO card_name_trigrams (card_name_trigrams) '
+     'VALUES (\'rebuild\')',
+     'CREATE VIRTUAL TABLE card_name_trigram_counts USING '
+     'fts5vocab(card_name_trigrams, row)'],
+    ['CREATE VIRTUAL TABLE card_texts USING fts5(oracle_text, original_text, '
+     'flavor, content=cards)',
+     'INSERT INTO card_texts (card_texts) VALUES (\'rebuild\')',
+     'CREATE INDEX cards_cmc ON cards (cmc)',
+     'CREATE INDEX cards_rarity ON cards (rarity COLLATE NOCASE)',
+     'CREATE INDEX card_colors_color ON card_colors (color COLLATE NOCASE)',
+     'CREATE INDEX card_types_type ON card_types (type COLLATE NOCASE)',
+     'CREATE INDEX card_subtypes_subtype ON card_subtypes '
+     '(subtype COLLATE NOCASE)',
+     'CREATE INDEX card_legalities_format ON card_legalities '
+     '(format COLLATE NOCASE, legality)'],
+    ['ALTER TABLE card_foreign_names ADD COLUMN norm_name',
+     'UPDATE card_foreign_names SET norm_name = normalize_name(name)',
+     'DROP INDEX card_foreign_names_name',
+     'CREATE INDEX card_foreign_names_norm_name ON card_foreign_names '
+     '(norm_name)'],
+    # Sets of a DB built before get their order of insertion, the order of
+    # the card data it was built from; DB.update() stores the current one.
+    # card_printings and card_defaults are first filled here, once their
+    # query can order sets by position.
+    ['ALTER TABLE sets ADD COLUMN position INTEGER',
+     'UPDATE sets SET position = rowid',
+     'DELETE FROM card_printings',
+     'DELETE FROM card_defaults',
+     card_printings_query.format(''),
+     card_defaults_query.format('')],
+]
+
+# English names for a normalize_name() form of a translated name, in the
+# order their translations were added to the DB.
+translation_query = \
+    'SELECT f.language, c.name FROM card_foreign_names f ' \
+    'JOIN cards c ON c.id = f.id WHERE f.norm_name = ? ' \
+    'GROUP BY f.language, c.name ORDER BY min(f.rowid)'
+
+# Filters of --search queries by name, with the table and the condition on
+# its rows each compiles to.
+search_filters = {
+    'cmc': ('cards', 'cmc {} ?'),
+    'color': ('card_colors', 'color = ? COLLATE NOCASE'),
+    'type': ('card_types', 'type = ? COLLATE NOCASE'),
+    'subtype': ('card_subtypes', 'subtype = ? COLLATE NOCASE'),
+    'rarity': ('cards', 'rarity = ? COLLATE NOCASE'),
+    'legal': ('card_legalities', 'format = ? COLLATE NOCASE '
+              'AND legality IN (\'Legal\', \'Restricted\')'),
+}
+
+# Statistics of --deck-stats by title, each with a query of value per entry
+# of the deck_entries temp table, given the entry's cards (with some of
+# their data) in deck_cards.
+# Split cards count with both halves: their mana values added up, and their
+# colors and types merged.
+deck_stats_queries = [
+    ('Mana curve (without lands)',
+     'SELECT k.entry, sum(k.cmc) AS value FROM deck_cards k '
+     'GROUP BY k.entry HAVING NOT EXISTS '
+     '(SELECT 1 FROM deck_cards l JOIN card_types t ON t.id = l.id '
+     'WHERE l.entry = k.entry AND t.type = \'Land\')'),
+    ('Colors',
+     'SELECT DISTINCT k.entry, coalesce(c.color, \'Colorless\') AS value '
+     'FROM deck_cards k LEFT JOIN card_colors c ON c.id = k.id'),
+    ('Color identity',
+     'SELECT DISTINCT k.entry, coalesce(c.color_identity, \'Colorless\') '
+     'AS value FROM deck_cards k '
+     'LEFT JOIN card_color_identities c ON c.id = k.id'),
+    ('Types',
+     'SELECT DISTINCT k.entry, t.type AS value FROM deck_cards k '
+     'JOIN card_types t ON t.id = k.id'),
+    ('Rarity',
+     'SELECT DISTINCT entry, rarity AS value FROM deck_cards'),
+]
+
+# Per card name of a deck in the deck tables (see create_deck_tables()), the
+# copies in main deck and sideboard together, the most restrictive legality
+# of its cards in a format, and whether any number of copies is allowed. The
+# legality is 0 for legal, 1 for restricted, 2 for banned, 3 where the format
+# does not list the card, and None for unknown names.
+deck_legality_query = \
+    'SELECT coalesce(d.card_name, d.name), sum(d.count), max(e.legality), ' \
+    'max(e.unlimited) FROM deck_entries d LEFT JOIN (SELECT k.entry, ' \
+    'max(CASE l.legality WHEN \'Legal\' THEN 0 WHEN \'Restricted\' ' \
+    'THEN 1 WHEN \'Banned\' THEN 2 ELSE 3 END) AS legality, ' \
+    'max(c.oracle_text LIKE \'%deck can have any number of cards named%\' ' \
+    'OR EXISTS (SELECT 1 FROM card_supertypes s WHERE s.id = k.id ' \
+    'AND s.supertype = \'Basic\')) AS unlimited FROM deck_cards k ' \
+    'JOIN cards c ON c.id = k.id LEFT JOIN card_legalities l ' \
+    'ON l.id = k.id AND l.format = ? COLLATE NOCASE GROUP BY k.entry) e ' \
+    'ON e.entry = d.rowid GROUP BY 1, d.card_name IS NULL ORDER BY 1'
+
+# Copies of a card allowed per deck by --check-legality, by lowercase format
+# name; other formats allow deck_copy_limit.
+deck_copy_limit = 4
+format_copy_limits = {'commander': 1}
+
+# Queries run per card lookup, which --check-query-plans ensures to be served
+# by indexes rather than full table scans.
+hot_path_queries = [
+    'SELECT set_name, id, use_multinames, card_count FROM card_defaults '
+    'WHERE name=?',
+    'SELECT id, use_multinames FROM card_printings WHERE name=? AND '
+    'set_name=?',
+    'SELECT name FROM card_names WHERE norm_name=?',
+    'SELECT doc FROM card_name_trigram_counts WHERE term=?',
+    'SELECT id FROM cards WHERE name=? AND set_name=?',
+    'SELECT name FROM card_multinames WHERE id=?',
+    'SELECT * FROM card_records WHERE id=?',
+    translation_query,
+]
+
 
 def parse_args():
     import argparse
@@ -53,13 +298,85 @@ def parse_args():
                         ' english original name')
     parser.add_argument('-d', dest='deck_file_name', action='store',
                         help='card deck file to browse in curses interface')
+    parser.add_argument('--translate-deck', dest='translate_deck_file_name',
+                        action='store',
+                        help='print card deck file with translated card '
+                        'names replaced by English ones')
+    parser.add_argument('--deck-stats', dest='deck_stats_file_name',
+                        action='store',
+                        help='print mana curve, color, type and rarity '
+                        'counts of card deck file')
+    parser.add_argument('--check-legality', dest='check_legality',
+                        action='store', nargs='+', metavar=('FORMAT', 'DECK'),
+                        help='check card deck files (or directories of '
+                        'them) for cards not legal in FORMAT and too many '
+                        'copies of cards')
+    parser.add_argument('--resolve-decks', dest='resolve_decks_path',
+                        action='store',
+                        help='print an NDJSON report of card counts, '
+                        'card ids and unknown card names per card deck '
+                        'file in directory')
+    parser.add_argument('--lookup', dest='lookup_name', action='store',
+                        metavar='NAME',
+                        help='print name and id of card NAME, fail if there '
+                        'is none, without opening the card DB')
+    parser.add_argument('--lookup-prefix', dest='lookup_prefix',
+                        action='store', metavar='PREFIX',
+                        help='print names and ids of all cards whose name '
+                        'starts with PREFIX, fail if there are none')
     parser.add_argument('-f', dest='template', action='store',
                         help='card data formatting template')
+    parser.add_argument('-b', dest='batch_file_name', action='store',
+                        help='file ("-" for stdin) of card names, one per '
+                        'line, each optionally followed by a tab and a set '
+                        'acronym, for which to view data in one run')
+    parser.add_argument('--search', dest='search_query', action='store',
+                        help='view data of cards matching query of '
+                        'full-text search words and filters like cmc<=2, '
+                        'color:, type:, subtype:, rarity:, legal:')
+    parser.add_argument('--separator', dest='separator', action='store',
+                        default='\\n',
+                        help='string (backslash escapes allowed) to separate '
+                        'the cards\' data viewed with -b or --search '
+                        '(default: "\\n")')
+    parser.add_argument('--render-cache', dest='render_cache',
+                        action='store_true',
+                        help='keep card data viewed with -c, -b or --search '
+                        'in a cache in ~/.mtgtool/ for later runs')
+    parser.add_argument('--render-cache-stats', dest='render_cache_stats',
+                        action='store_true',
+                        help='show hit/miss counts and size of the '
+                        '--render-cache cache')
     parser.add_argument('-q', dest='quiet', action='store_true',
                         help='suppress non-essential messages')
     parser.add_argument('--test-parser',
                         dest='deck_file_name_debug', action='store',
                         help='run deck file through parser for debugging')
+    parser.add_argument('--rebuild-db', dest='rebuild_db', action='store_true',
+                        help='rebuild card DB from freshly retrieved card '
+                        'data, report insertion speed per table')
+    parser.add_argument('--update', dest='update', action='store_true',
+                        help='update card DB with freshly retrieved card '
+                        'data, re-inserting only new or changed sets')
+    parser.add_argument('--build-workers', dest='build_workers',
+                        action='store', type=int, metavar='N',
+                        help='number of processes preparing card data for '
+                        'DB builds and updates (default: number of CPUs)')
+    parser.add_argument('--mtgjson-url', dest='mtgjson_url',
+                        action='store', default=mtgjson_url,
+                        help='retrieve card data from URL instead of ' +
+                        mtgjson_url)
+    parser.add_argument('--serve', dest='serve', action='store_true',
+                        help='keep serving card lookups to other mtgtool.py '
+                        'runs over a Unix socket in ~/.mtgtool/')
+    parser.add_argument('--server-stats', dest='server_stats',
+                        action='store_true',
+                        help='show request latency stats of running --serve '
+                        'process')
+    parser.add_argument('--check-query-plans', dest='check_query_plans',
+                        action='store_true',
+                        help='fail if any card lookup query needs a full '
+                        'table scan')
     return parser, parser.parse_args()
 
 
@@ -69,70 +386,838 @@ def print_verbose(msg):
         print(msg)
 
 
+def iter_json_object_items(json_file, chunk_size=1 << 20, with_json=False,
+                           decode_values=True):
+    # Yields key, value pairs of the JSON object in json_file one at a time.
+    # Only the value currently decoded (plus one read chunk) is kept in
+    # memory, instead of the whole object graph json.load() would build. If
+    # with_json is set, the JSON source of each value is yielded as a third
+    # item. Without decode_values, values are only delimited in the JSON
+    # source, and None is yielded in their place.
+    import json
+    import re
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+    # Scans values like decoder, but drops each object as soon as it is
+    # parsed, so no object graph is built up.
+    delimiter = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more(size):
+        nonlocal buf, pos, eof
+        chunk = json_file.read(size)
+        if chunk == '':
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            pos = whitespace.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return
+            read_more(chunk_size)
+
+    def expect(chars):
+        nonlocal pos
+        skip_whitespace()
+        if pos == len(buf) or buf[pos] not in chars:
+            raise json.JSONDecodeError('Expecting one of: ' + chars, buf, pos)
+        pos += 1
+        return buf[pos - 1]
+
+    def decode_value(decode=True):
+        nonlocal pos
+        skip_whitespace()
+        size = chunk_size
+        while True:
+            try:
+                start = pos
+                if decode:
+                    value, pos = decoder.raw_decode(buf, pos)
+                else:
+                    value = None
+                    _, pos = delimiter.raw_decode(buf, pos)
+                return value, buf[start:pos]
+            except json.JSONDecodeError:
+                # Value may just be cut off by the end of the buffer; read
+                # on with growing chunk sizes to keep re-decoding linear.
+                if eof:
+                    raise
+                read_more(size)
+                size *= 2
+
+    expect('{')
+    skip_whitespace()
+    if pos < len(buf) and buf[pos] == '}':
+        return
+    while True:
+        key, _ = decode_value()
+        expect(':')
+        value, value_json = decode_value(decode_values)
+        yield (key, value, value_json) if with_json else (key, value)
+        if expect(',}') == '}':
+            return
+
+
+def set_fingerprint(mtgjson_set, set_json):
+    # Returns card count and content hash of mtgjson_set decoded from
+    # set_json. The cards' printings are left out of the hash, as they change
+    # in all sets featuring a card whenever it is reprinted in a new one.
+    import hashlib
+    import re
+    h = hashlib.sha1()
+    h.update(re.sub(r'"printings":\s*\[[^\]]*\]', '', set_json).encode())
+    return len(mtgjson_set['cards']), h.hexdigest()
+
+
+def add_set_cards(insert, set_name, mtgjson_set):
+    split_cards = []
+    for card in mtgjson_set['cards']:
+        if card['layout'] == 'split':
+            ensure_split_entry(insert, split_cards, card, set_name)
+        add_card_entry(insert, set_name, card)
+
+
+def ensure_split_entry(insert, split_cards, card, set_name):
+    import hashlib
+    split_name = card['names'][0] + ' // ' + card['names'][1]
+    if split_name not in split_cards:
+        split_cards += [split_name]
+        h = hashlib.sha1()
+        # How the hash is constructed according to some reverse engineering
+        # and <http://mtgjson.com/documentation.html>
+        to_hash = set_name + split_name + card['imageName']
+        h.update(to_hash.encode())
+        hex_hash = h.hexdigest()
+        insert('cards', {'id': hex_hash, 'name': split_name,
+                         'set_name': set_name, 'use_multinames': 1})
+        insert('card_multinames', {'id': hex_hash, 'name': card['names'][0]})
+        insert('card_multinames', {'id': hex_hash, 'name': card['names'][1]})
+
+
+def add_card_entry(insert, set_name, card):
+
+    def insert_into_array_table(table, col, key):
+        if key in card:
+            for element in card[key]:
+                insert(table, {'id': card['id'], col: element})
+
+    for key in ('manaCost', 'text', 'flavor', 'power', 'toughness', 'cmc',
+                'loyalty', 'hand', 'life', 'originalType', 'originalText'):
+        if key not in card:
+            card[key] = None
+    insert('cards',
+           {'id': card['id'], 'set_name': set_name,
+            'name': card['name'], 'layout': card['layout'],
+            'mana_cost': card['manaCost'],
+            'oracle_type': card['type'],
+            'original_type': card['originalType'],
+            'rarity': card['rarity'], 'oracle_text': card['text'],
+            'original_text': card['originalText'],
+            'flavor': card['flavor'], 'power': card['power'],
+            'toughness': card['toughness'], 'cmc': card['cmc'],
+            'loyalty': card['loyalty'], 'hand': card['hand'],
+            'life': card['life'], 'use_multinames': 0})
+    insert_into_array_table('card_multinames', 'name', 'names')
+    insert_into_array_table('card_sets', 'set_name', 'printings')
+    insert_into_array_table('card_colors', 'color', 'colors')
+    insert_into_array_table('card_color_identities', 'color_identity',
+                            'colors')
+    insert_into_array_table('card_supertypes', 'supertype', 'supertypes')
+    insert_into_array_table('card_types', 'type', 'types')
+    insert_into_array_table('card_subtypes', 'subtype', 'subtypes')
+    if 'rulings' in card:
+        for ruling in card['rulings']:
+            insert('card_rulings',
+                   {'id': card['id'], 'date': ruling['date'],
+                    'text': ruling['text']})
+    if 'foreignNames' in card:
+        for foreign_name in card['foreignNames']:
+            insert('card_foreign_names',
+                   {'id': card['id'],
+                    'language': foreign_name['language'],
+                    'name': foreign_name['name']})
+    if 'legalities' in card:
+        for legality in card['legalities']:
+            insert('card_legalities',
+                   {'id': card['id'], 'format': legality['format'],
+                    'legality': legality['legality']})
+
+
+def init_ingest_worker(stored_fingerprints):
+    global ingest_fingerprints
+    ingest_fingerprints = stored_fingerprints
+
+
+def ingest_set(item):
+    # Turns a set into its rows ready to insert, per table and set of columns
+    # in insertion order, and the normalize_name() forms of all its card
+    # names. Sets whose fingerprint matches the stored one are left out.
+    import json
+    set_name, mtgjson_set, set_json = item
+    if mtgjson_set is None:
+        mtgjson_set = json.loads(set_json)
+    date = mtgjson_set['releaseDate']
+    fingerprint = set_fingerprint(mtgjson_set, set_json)
+    if ingest_fingerprints.get(set_name) == (date,) + fingerprint:
+        return set_name, date, fingerprint, None, None, None
+    rows = {}
+
+    def insert(table, d):
+        rows.setdefault((table, tuple(d)), []).append(tuple(d.values()))
+
+    add_set_cards(insert, set_name, mtgjson_set)
+    printings = [(card['name'], card.get('printings', [])) for card in
+                 mtgjson_set['cards']]
+    names = set()
+    for (table, columns), table_rows in rows.items():
+        if table in ('cards', 'card_foreign_names'):
+            column = columns.index('name')
+            names.update(row[column] for row in table_rows)
+    norm_names = {name: normalize_name(name) for name in names}
+    return set_name, date, fingerprint, rows, printings, norm_names
+
+
+def db_file_fingerprint(path):
+    # The DB file is only ever replaced, never written in place, so its inode,
+    # mtime and size identify a build of it.
+    stat = os.stat(path)
+    return '%d:%d:%d' % (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def write_name_index(path, rows, fingerprint):
+    import array
+    import struct
+    records = sorted([b'\0'.join([field.encode() for field in row])
+                      for row in rows])
+    offsets = array.array('I', [0])
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    temp_path = path + '.' + str(os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack(name_index_format, name_index_magic,
+                            name_index_version, len(records),
+                            fingerprint.encode()))
+        f.write(offsets.tobytes())
+        f.write(b''.join(records))
+    os.replace(temp_path, path)
+
+
+def find_card_names(cursor, norm_name, prefix=False):
+    # Same as NameIndex.find(), from the DB.
+    if prefix:
+        condition = 'WHERE n.norm_name >= ? AND n.norm_name < ?'
+        params = (norm_name, norm_name + '\U0010ffff')
+    else:
+        condition = 'WHERE n.norm_name = ?'
+        params = (norm_name,)
+    return [(name, card_id) for _, name, card_id in
+            cursor.execute(name_index_query.format(condition), params)]
+
+
+def normalize_name(name):
+    # Case- and accent-insensitive form of a card name.
+    import unicodedata
+    name = ''.join([char for char in unicodedata.normalize('NFKD', name)
+                    if not unicodedata.combining(char)])
+    return ' '.join(name.casefold().replace('æ', 'ae').split())
+
+
+def suggest_card_names(cursor, card_name, limit=5):
+    # Ranking candidates by all trigrams of the name is slow when some are
+    # shared by thousands of names; the rarest few trigrams select a small
+    # candidate set just as well, as one typo only breaks up to three of
+    # them. The best-ranked candidates are then sorted by similarity.
+    import difflib
+    norm_name = normalize_name(card_name)
+    trigram_counts = []
+    for trigram in {norm_name[i:i + 3] for i in range(len(norm_name) - 2)}:
+        cursor.execute('SELECT doc FROM card_name_trigram_counts '
+                       'WHERE term=?', (trigram,))
+        row = cursor.fetchone()
+        if row is not None:
+            trigram_counts += [(row[0], trigram)]
+    if not trigram_counts:
+        return []
+    query = ' OR '.join(['"' + trigram.replace('"', '""') + '"'
+                         for _, trigram in sorted(trigram_counts)[:5]])
+    candidates = cursor.execute('SELECT n.name, n.norm_name '
+                                'FROM card_name_trigrams t '
+                                'JOIN card_names n ON n.rowid = t.rowid '
+                                'WHERE card_name_trigrams MATCH ? '
+                                'ORDER BY rank LIMIT 20', (query,)).fetchall()
+    matcher = difflib.SequenceMatcher(b=norm_name)
+    ranked = []
+    for name, candidate in candidates:
+        matcher.set_seq1(candidate)
+        ratio = matcher.ratio()
+        if ratio >= 0.6:
+            ranked += [(-ratio, name)]
+    return [name for _, name in sorted(ranked)[:limit]]
+
+
 class DB:
 
-    def __init__(self):
+    def __init__(self, rebuild=False, update=False, build_workers=None):
+        # DB writes go to a shadow copy swapped in for the DB file when
+        # complete, so readers never see a half-written DB, and keep
+        # reading the old one if they opened it before the swap.
+        import http.client
+        import sys
         self.db_dir = os.getenv('HOME') + '/.mtgtool/'
         if not os.path.exists(self.db_dir):
             os.makedirs(self.db_dir)
         self.sql_file = self.db_dir + 'db.sqlite'
-        if not (os.path.isfile(self.sql_file)):
-            print_verbose('No MTG card sets DB found, constructing it in ' +
-                          self.db_dir + ' …')
-            self.create_db()
+        self.shadow_sql_file = self.sql_file + '.shadow'
+        self.name_index_file = self.db_dir + 'names.idx'
+        self.mtgjson_file = self.db_dir + 'AllSets-x.json.zip'
+        self.mtgjson_meta_file = self.mtgjson_file + '.meta'
+        self.insert_stats = {}
+        self.build_workers = build_workers or os.cpu_count()
+        self.norm_names = {}
+        if rebuild or update or not os.path.isfile(self.sql_file):
+            self.lock()
+            try:
+                # Another process may have built the DB while we waited;
+                # unless asked for an update, it is then used as it is.
+                build = rebuild or not os.path.isfile(self.sql_file)
+                if build and not rebuild:
+                    print_verbose('No MTG card sets DB found, constructing '
+                                  'it in ' + self.db_dir + ' …')
+                if build or update:
+                    try:
+                        changed = self.fetch_mtgjson()
+                    except ValueError as err:
+                        print(err, file=sys.stderr)
+                        exit(1)
+                    except (OSError, http.client.HTTPException) as err:
+                        # A download cut short is kept to be resumed.
+                        print('Cannot retrieve ' + mtgjson_url + ': ' +
+                              str(err), file=sys.stderr)
+                        exit(1)
+                if build:
+                    self.open_shadow(copy_live=False)
+                    self.create_db()
+                    self.close_shadow()
+                    self.mark_mtgjson_built()
+                elif update and not changed:
+                    print_verbose('Card DB is up to date.')
+                elif update:
+                    self.open_shadow(copy_live=True)
+                    migrated = self.migrate()
+                    updated_sets, removed_sets, is_reordered = self.update()
+                    self.close_shadow(migrated or is_reordered or
+                                      bool(updated_sets or removed_sets))
+                    self.mark_mtgjson_built()
+                    # Reported only once the update is in place, so failing
+                    # output (like that of --update | head) can't lose it.
+                    if updated_sets:
+                        print_verbose('Updated sets: ' +
+                                      ', '.join(updated_sets))
+                    if removed_sets:
+                        print_verbose('Removed sets: ' +
+                                      ', '.join(removed_sets))
+                    if not (updated_sets or removed_sets):
+                        print_verbose('Updated order of sets.' if is_reordered
+                                      else 'Card DB is up to date.')
+            finally:
+                self.unlock()
+        self.connect()
+        if self.get_schema_version() < len(migrations):
+            self.conn.close()
+            self.lock()
+            try:
+                self.open_shadow(copy_live=True)
+                self.close_shadow(self.migrate())
+            finally:
+                self.unlock()
+            self.connect()
+
+    def connect(self):
+        # The build fingerprint is taken before opening the DB: a DB swapped
+        # in meanwhile then goes by the old fingerprint, to be noticed as
+        # changed on the next run, rather than the other way round.
+        self.build_fingerprint = db_file_fingerprint(self.sql_file)
+        self.conn = sqlite3.connect(self.sql_file)
+        self.cursor = self.conn.cursor()
+
+    def lock(self):
+        import fcntl
+        self.lock_file = open(self.db_dir + 'db.lock', 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print_verbose('Waiting for other process to finish writing the '
+                          'MTG card sets DB …')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def unlock(self):
+        self.lock_file.close()
+
+    def open_shadow(self, copy_live):
+        # Left-overs of a crashed earlier run are discarded.
+        for path in (self.shadow_sql_file, self.shadow_sql_file + '-journal'):
+            if os.path.exists(path):
+                os.remove(path)
+        self.conn = sqlite3.connect(self.shadow_sql_file)
+        self.cursor = self.conn.cursor()
+        if copy_live:
+            live_conn = sqlite3.connect(self.sql_file)
+            live_conn.backup(self.conn)
+            live_conn.close()
+        # Nobody reads the shadow DB before it is complete, so no need to
+        # protect it against crashes.
+        self.set_pragmas(build_pragmas)
+        self.conn.create_function('normalize_name', 1,
+                                  self.normalize_ingested_name,
+                                  deterministic=True)
+
+    def close_shadow(self, swap_in=True):
+        if swap_in:
+            name_rows = self.cursor.execute(
+                name_index_query.format('')).fetchall()
+        self.conn.close()
+        if swap_in:
+            with open(self.shadow_sql_file, 'rb+') as f:
+                os.fsync(f.fileno())
+            # Replacing the file keeps its fingerprint, and the name index is
+            # only taken for current once the DB it belongs to is in place.
+            write_name_index(self.name_index_file, name_rows,
+                             db_file_fingerprint(self.shadow_sql_file))
+            os.replace(self.shadow_sql_file, self.sql_file)
         else:
-            self.conn = sqlite3.connect(self.sql_file)
-            self.cursor = self.conn.cursor()
+            os.remove(self.shadow_sql_file)
+
+    def get_schema_version(self):
+        return self.cursor.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, announce=True):
+        version = self.get_schema_version()
+        for i in range(version, len(migrations)):
+            if announce:
+                print_verbose('Upgrading DB schema to version ' +
+                              str(i + 1) + ' …')
+            self.cursor.execute('BEGIN')
+            for statement in migrations[i]:
+                self.cursor.execute(statement)
+            self.cursor.execute('PRAGMA user_version = ' + str(i + 1))
+            self.conn.commit()
+        return version < len(migrations)
+
+    def check_query_plans(self):
+        has_scans = False
+        for query in hot_path_queries:
+            plan = [row[3] for row in self.cursor.execute(
+                    'EXPLAIN QUERY PLAN ' + query,
+                    (None,) * query.count('?'))]
+            # Virtual tables always "scan", but with a non-zero index number
+            # they use a constraint instead of visiting every row.
+            is_scan = any([step.startswith('SCAN') and
+                           'VIRTUAL TABLE INDEX 0:' in step or
+                           step.startswith('SCAN') and
+                           'VIRTUAL TABLE' not in step for step in plan])
+            has_scans = has_scans or is_scan
+            print('SCAN' if is_scan else 'OK', query)
+            for step in plan:
+                print('  ' + step)
+        return not has_scans
+
+    def set_pragmas(self, pragmas):
+        for pragma in pragmas:
+            self.cursor.execute('PRAGMA %s = %s' % (pragma, pragmas[pragma]))
 
     def insert(self, table, d):
-        keys = []
-        values = []
-        for key in d:
-            keys += [key]
-            values += [d[key]]
-        placeholders = ', '.join(len(keys) * ['?'])
-        keys = ', '.join(keys)
-        code = 'INSERT INTO %s (%s) VALUES (%s)' % (table, keys, placeholders)
-        self.cursor.execute(code, values)
+        # Rows are only queued here, to be written in batches by
+        # flush_inserts(), per table and set of columns given.
+        queue_key = (table, tuple(d))
+        if queue_key not in self.insert_queues:
+            self.insert_queues[queue_key] = []
+        rows = self.insert_queues[queue_key]
+        rows += [tuple(d.values())]
+        if len(rows) >= insert_batch_size:
+            self.flush_inserts(queue_key)
+
+    def flush_inserts(self, queue_key=None):
+        import time
+        queue_keys = [queue_key] if queue_key else list(self.insert_queues)
+        for queue_key in queue_keys:
+            table, columns = queue_key
+            rows = self.insert_queues.pop(queue_key)
+            code = 'INSERT INTO %s (%s) VALUES (%s)' % \
+                (table, ', '.join(columns), ', '.join(len(columns) * ['?']))
+            time_start = time.perf_counter()
+            self.cursor.executemany(code, rows)
+            if table not in self.insert_stats:
+                self.insert_stats[table] = [0, 0.0]
+            self.insert_stats[table][0] += len(rows)
+            self.insert_stats[table][1] += time.perf_counter() - time_start
+
+    def normalize_ingested_name(self, name):
+        norm_name = self.norm_names.get(name)
+        return normalize_name(name) if norm_name is None else norm_name
+
+    def insert_rows(self, queue_key, rows):
+        # Same as insert() for each row, so batches are flushed at the same
+        # rows no matter how many rows arrive at once.
+        queue = self.insert_queues.setdefault(queue_key, [])
+        while len(queue) + len(rows) >= insert_batch_size:
+            split = insert_batch_size - len(queue)
+            queue += rows[:split]
+            rows = rows[split:]
+            self.flush_inserts(queue_key)
+            queue = self.insert_queues.setdefault(queue_key, [])
+        queue += rows
+
+    def ingest_sets(self, stored_fingerprints):
+        # Worker processes turn sets into rows while this process alone
+        # writes them to the DB, in the order of the sets in the card data,
+        # so the DB comes out the same for any number of workers. Only a few
+        # sets per worker are handed out ahead of the writer, to bound the
+        # memory held by sets waiting to be written.
+        import collections
+        import multiprocessing
+        # With workers, this process only finds where sets start and end in
+        # the card data, and they decode them.
+        sets = self.get_mtg_sets(decode_sets=self.build_workers == 1)
+        if self.build_workers == 1:
+            init_ingest_worker(stored_fingerprints)
+            yield from map(ingest_set, sets)
+            return
+        context = multiprocessing.get_context('fork')
+        with context.Pool(self.build_workers, init_ingest_worker,
+                          (stored_fingerprints,)) as pool:
+            pending = collections.deque()
+            for item in sets:
+                pending.append(pool.apply_async(ingest_set, (item,)))
+                if len(pending) > 2 * self.build_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def write_ingested_set(self, rows, norm_names):
+        self.norm_names.update(norm_names)
+        for queue_key in rows:
+            self.insert_rows(queue_key, rows[queue_key])
 
     def create_db(self):
-        mtgjson_dict = self.get_mtg_dict()
-        self.conn = sqlite3.connect(self.sql_file)
-        self.cursor = self.conn.cursor()
+        print_verbose('Creating sqlite DB …')
+        self.insert_queues = {}
+        self.insert_stats = {}
         self.create_tables()
-        cards = []
-        set_dates = {}
-        for set_name in mtgjson_dict:
-            set_dates[set_name] = mtgjson_dict[set_name]['releaseDate']
-            self.insert('sets',
-                        {'name': set_name,
-                         'date': mtgjson_dict[set_name]['releaseDate']})
-            split_cards = []
-            for card in mtgjson_dict[set_name]['cards']:
-                if card['layout'] == 'split':
-                    self.ensure_split_entry(split_cards, card, set_name)
-                self.add_card_entry(set_name, card)
+        fingerprints = {}
+        for set_name, date, fingerprint, rows, _, norm_names in \
+                self.ingest_sets({}):
+            fingerprints[set_name] = fingerprint
+            self.insert('sets', {'name': set_name, 'date': date})
+            self.write_ingested_set(rows, norm_names)
+        self.flush_inserts()
+        self.conn.commit()
+        self.migrate(announce=False)
+        self.store_fingerprints(fingerprints)
+        self.store_positions(list(fingerprints))
         self.conn.commit()
 
-    def get_mtg_dict(self):
-        import urllib.request
-        import zipfile
+    def update(self):
+        # Returns the names of the sets updated and of those removed, and
+        # whether sets kept have moved in the card data.
+        print_verbose('Updating sqlite DB …')
+        stored_fingerprints = {row[0]: tuple(row[1:]) for row in
+                               self.cursor.execute('SELECT name, date, '
+                                                   'card_count, content_hash '
+                                                   'FROM sets')}
+        stored_positions = dict(self.cursor.execute('SELECT name, position '
+                                                    'FROM sets'))
+        self.insert_queues = {}
+        self.insert_stats = {}
+        fingerprints = {}
+        printings = {}
+        set_names = []
+        self.cursor.execute('CREATE TEMP TABLE changed_names '
+                            '(name PRIMARY KEY) WITHOUT ROWID')
+        for set_name, date, fingerprint, rows, set_printings, norm_names in \
+                self.ingest_sets(dict(stored_fingerprints)):
+            set_names.append(set_name)
+            if set_name not in stored_fingerprints:
+                self.insert('sets', {'name': set_name, 'date': date})
+            elif rows is None:
+                del stored_fingerprints[set_name]
+                continue
+            else:
+                del stored_fingerprints[set_name]
+                self.store_changed_names(set_name)
+                self.delete_set_cards(set_name)
+                self.cursor.execute('UPDATE sets SET date=? WHERE name=?',
+                                    (date, set_name))
+            fingerprints[set_name] = fingerprint
+            printings.update(set_printings)
+            self.write_ingested_set(rows, norm_names)
+        self.flush_inserts()
+        removed_sets = list(stored_fingerprints)
+        for set_name in removed_sets:
+            # Cards of other sets also printed in the removed one lose it
+            # from their printings, so their records are rebuilt, too.
+            printed_ids = self.cursor.execute(
+                'SELECT id FROM card_sets WHERE set_name=?',
+                (set_name,)).fetchall()
+            self.store_changed_names(set_name)
+            self.delete_set_cards(set_name)
+            self.cursor.execute('DELETE FROM sets WHERE name=?', (set_name,))
+            self.cursor.execute('DELETE FROM card_sets WHERE set_name=?',
+                                (set_name,))
+            self.cursor.executemany(card_records_query + ' WHERE id=?',
+                                    printed_ids)
+        self.store_fingerprints(fingerprints)
+        positions = {set_name: i for i, set_name in enumerate(set_names, 1)}
+        is_reordered = any(positions[set_name] != stored_positions[set_name]
+                           for set_name in positions
+                           if set_name in stored_positions)
+        self.store_reordered_names(stored_positions, positions)
+        self.store_positions(set_names)
+        for set_name in fingerprints:
+            self.cursor.execute(card_records_query + ' WHERE set_name=?',
+                                (set_name,))
+            self.cursor.execute('INSERT INTO card_texts (rowid, oracle_text, '
+                                'original_text, flavor) SELECT rowid, '
+                                'oracle_text, original_text, flavor '
+                                'FROM cards WHERE set_name=?', (set_name,))
+            self.store_changed_names(set_name)
+        self.cursor.execute('UPDATE card_foreign_names '
+                            'SET norm_name = normalize_name(name) '
+                            'WHERE norm_name IS NULL')
+        self.cursor.execute('DELETE FROM card_printings WHERE name IN '
+                            '(SELECT name FROM changed_names)')
+        self.cursor.execute('DELETE FROM card_defaults WHERE name IN '
+                            '(SELECT name FROM changed_names)')
+        names_condition = 'WHERE c.name IN (SELECT name FROM changed_names)'
+        self.cursor.execute(card_printings_query.format(names_condition))
+        self.cursor.execute(card_defaults_query.format(names_condition))
+        self.cursor.execute('INSERT INTO card_name_trigrams '
+                            '(card_name_trigrams, rowid, norm_name) '
+                            'SELECT \'delete\', rowid, norm_name '
+                            'FROM card_names WHERE name IN '
+                            '(SELECT name FROM changed_names)')
+        self.cursor.execute('DELETE FROM card_names WHERE name IN '
+                            '(SELECT name FROM changed_names)')
+        self.cursor.execute(card_names_query.format(names_condition))
+        self.cursor.execute('INSERT INTO card_name_trigrams '
+                            '(rowid, norm_name) '
+                            'SELECT rowid, norm_name FROM card_names '
+                            'WHERE name IN (SELECT name FROM changed_names)')
+        self.cursor.execute('DROP TABLE changed_names')
+        # Set fingerprints ignore card printings, so a new set does not mark
+        # every set with reprints of its cards as changed; instead, update
+        # the printings of cards outside the changed sets directly.
+        for name in printings:
+            for card_id, set_name in self.cursor.execute(
+                    'SELECT id, set_name FROM cards WHERE name=?',
+                    (name,)).fetchall():
+                if set_name in fingerprints:
+                    continue
+                card_printings = [row[0] for row in self.cursor.execute(
+                                  'SELECT set_name FROM card_sets '
+                                  'WHERE id=?', (card_id,))]
+                if card_printings != printings[name]:
+                    self.cursor.execute('DELETE FROM card_sets WHERE id=?',
+                                        (card_id,))
+                    for printing in printings[name]:
+                        self.insert('card_sets', {'id': card_id,
+                                                  'set_name': printing})
+                    self.flush_inserts()
+                    self.cursor.execute(card_records_query + ' WHERE id=?',
+                                        (card_id,))
+        self.conn.commit()
+        return list(fingerprints), removed_sets, is_reordered
+
+    def delete_set_cards(self, set_name):
+        self.cursor.execute('INSERT INTO card_texts (card_texts, rowid, '
+                            'oracle_text, original_text, flavor) '
+                            'SELECT \'delete\', rowid, oracle_text, '
+                            'original_text, flavor FROM cards '
+                            'WHERE set_name=?', (set_name,))
+        for table in ('multinames', 'sets', 'colors', 'color_identities',
+                      'supertypes', 'types', 'subtypes', 'rulings',
+                      'foreign_names', 'legalities', 'records'):
+            self.cursor.execute('DELETE FROM card_' + table + ' WHERE id IN '
+                                '(SELECT id FROM cards WHERE set_name=?)',
+                                (set_name,))
+        self.cursor.execute('DELETE FROM cards WHERE set_name=?', (set_name,))
+
+    def store_changed_names(self, set_name):
+        self.cursor.execute('INSERT OR IGNORE INTO changed_names '
+                            'SELECT name FROM cards WHERE set_name=?',
+                            (set_name,))
+
+    def store_reordered_names(self, stored_positions, positions):
+        # Printings of the same release date go by set order, so the cards of
+        # sets kept with the same date, but now in another order, need their
+        # printings redone.
+        sets_by_date = {}
+        for set_name, date in self.cursor.execute('SELECT name, date '
+                                                  'FROM sets'):
+            if set_name in stored_positions:
+                sets_by_date.setdefault(date, []).append(set_name)
+        for date_sets in sets_by_date.values():
+            if sorted(date_sets, key=stored_positions.get) != \
+                    sorted(date_sets, key=positions.get):
+                for set_name in date_sets:
+                    self.store_changed_names(set_name)
+
+    def store_positions(self, set_names):
+        self.cursor.executemany('UPDATE sets SET position=? WHERE name=?',
+                                list(enumerate(set_names, 1)))
+
+    def store_fingerprints(self, fingerprints):
+        self.cursor.executemany('UPDATE sets SET card_count=?, content_hash=? '
+                                'WHERE name=?',
+                                [fingerprints[set_name] + (set_name,)
+                                 for set_name in fingerprints])
+
+    def print_build_stats(self):
+        for table in sorted(self.insert_stats):
+            rows, seconds = self.insert_stats[table]
+            print('%s: %d rows, %d rows/second' %
+                  (table, rows, rows / seconds if seconds else 0))
+
+    def read_mtgjson_meta(self):
         import json
+        try:
+            with open(self.mtgjson_meta_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_mtgjson_meta(self, meta):
+        import json
+        with open(self.mtgjson_meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.mtgjson_meta_file + '.tmp', self.mtgjson_meta_file)
+
+    def fetch_mtgjson(self):
+        # The archive is kept between runs, along with its HTTP validators, so
+        # unchanged card data costs one conditional request, and a download
+        # cut short is resumed by a range request. Returns whether the archive
+        # differs from the one the DB was last built from.
+        import shutil
+        import urllib.error
+        import urllib.request
+        meta = self.read_mtgjson_meta()
+        part_file = self.mtgjson_file + '.part'
+        headers = {}
+        if meta.get('url') == mtgjson_url and \
+                os.path.isfile(self.mtgjson_file):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        part = meta.get('part', {})
+        # Weak ETags must not be used to resume a download.
+        etag = part.get('etag')
+        validator = etag if etag and not etag.startswith('W/') else \
+            part.get('last_modified')
+        offset = 0
+        if part.get('url') == mtgjson_url and validator and \
+                os.path.isfile(part_file):
+            offset = os.path.getsize(part_file)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
         print_verbose('Retrieving JSON of all MTG card sets …')
-        json_file_path = self.db_dir + 'AllSets-x.json'
-        json_zipped_file_path = json_file_path + '.zip'
-        urllib.request.urlretrieve(mtgjson_url, json_zipped_file_path)
-        print_verbose('Unzipping JSON …')
-        zip_ref = zipfile.ZipFile(json_zipped_file_path, 'r')
-        zip_ref.extract('AllSets-x.json', self.db_dir)
-        zip_ref.close()
-        mtgjson_file = open(json_file_path, 'r')
-        print_verbose('Creating sqlite DB …')
-        mtgjson_dict = json.load(mtgjson_file)
-        mtgjson_file.close()
-        os.remove(json_file_path)
-        os.remove(json_zipped_file_path)
-        return mtgjson_dict
+        request = urllib.request.Request(mtgjson_url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as err:
+            if err.code == 304:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                meta.pop('part', None)
+                if 'sha256' not in meta:
+                    # The kept archive can't be told apart from the one the
+                    # DB was built from, so it is retrieved anew.
+                    meta.pop('etag', None)
+                    meta.pop('last_modified', None)
+                    self.write_mtgjson_meta(meta)
+                    return self.fetch_mtgjson()
+                print_verbose('Card data unchanged since last retrieval.')
+                self.write_mtgjson_meta(meta)
+                return meta['sha256'] != meta.get('built_sha256')
+            if err.code == 416 and offset:
+                os.remove(part_file)
+                return self.fetch_mtgjson()
+            raise
+        with response:
+            resumed = response.status == 206 and \
+                response.headers.get('Content-Range', '').startswith(
+                    'bytes %d-' % offset)
+            if not resumed:
+                meta['part'] = {
+                    'url': mtgjson_url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')}
+                self.write_mtgjson_meta(meta)
+            with open(part_file, 'ab' if resumed else 'wb') as f:
+                shutil.copyfileobj(response, f)
+                size = f.tell()
+            length = response.headers.get('Content-Length')
+            if length and size < (offset if resumed else 0) + int(length):
+                raise OSError('Download cut short, run again to resume '
+                              'it.')
+        sha256 = self.check_mtgjson_archive(part_file)
+        part = meta.pop('part')
+        os.replace(part_file, self.mtgjson_file)
+        meta.update(part, sha256=sha256)
+        self.write_mtgjson_meta(meta)
+        return sha256 != meta.get('built_sha256')
+
+    def check_mtgjson_archive(self, path):
+        # Checked against the checksum file published next to the archive if
+        # there is one, else against the CRCs of the zip entries. Returns the
+        # archive's SHA-256.
+        import hashlib
+        import urllib.error
+        import urllib.request
+        import zipfile
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+        sha256 = file_hash.hexdigest()
+        try:
+            with urllib.request.urlopen(mtgjson_url + '.sha256') as response:
+                published = response.read().decode('ascii').split()[0].lower()
+        except (urllib.error.URLError, UnicodeDecodeError, IndexError):
+            published = None
+        if published:
+            is_good = sha256 == published
+        else:
+            try:
+                with zipfile.ZipFile(path, 'r') as zip_ref:
+                    is_good = zip_ref.testzip() is None
+            except zipfile.BadZipFile:
+                is_good = False
+        if not is_good:
+            os.remove(path)
+            raise ValueError('Checksum mismatch in retrieved ' + mtgjson_url)
+        return sha256
+
+    def mark_mtgjson_built(self):
+        meta = self.read_mtgjson_meta()
+        meta['built_sha256'] = meta['sha256']
+        self.write_mtgjson_meta(meta)
+
+    def get_mtg_sets(self, decode_sets=True):
+        import zipfile
+        import io
+        # Decode the zipped JSON set by set straight from the archive, so at
+        # no point more than one set's data is held in memory.
+        with zipfile.ZipFile(self.mtgjson_file, 'r') as zip_ref:
+            with zip_ref.open('AllSets-x.json') as zipped_file:
+                mtgjson_file = io.TextIOWrapper(zipped_file, encoding='utf-8')
+                yield from iter_json_object_items(mtgjson_file,
+                                                  with_json=True,
+                                                  decode_values=decode_sets)
 
     def create_tables(self):
         self.cursor.execute('CREATE TABLE sets ('
@@ -202,217 +1287,578 @@ class DB:
                             'legality TEXT, '
                             'FOREIGN KEY(id) REFERENCES cards(id))')
 
-    def ensure_split_entry(self, split_cards, card, set_name):
-        import hashlib
-        split_name = card['names'][0] + ' // ' + card['names'][1]
-        if split_name not in split_cards:
-            split_cards += [split_name]
-            h = hashlib.sha1()
-            # How the hash is constructed according to some reverse engineering
-            # and <http://mtgjson.com/documentation.html>
-            to_hash = set_name + split_name + card['imageName']
-            h.update(to_hash.encode())
-            hex_hash = h.hexdigest()
-            self.insert('cards', {'id': hex_hash, 'name': split_name,
-                                  'set_name': set_name, 'use_multinames': 1})
-            self.insert('card_multinames', {'id': hex_hash,
-                                            'name': card['names'][0]})
-            self.insert('card_multinames', {'id': hex_hash,
-                                            'name': card['names'][1]})
-
-    def add_card_entry(self, set_name, card):
-
-        def insert_into_array_table(table, col, key):
-            if key in card:
-                for element in card[key]:
-                    self.insert(table, {'id': card['id'], col: element})
-
-        for key in ('manaCost', 'text', 'flavor', 'power', 'toughness', 'cmc',
-                    'loyalty', 'hand', 'life', 'originalType', 'originalText'):
-            if key not in card:
-                card[key] = None
-        self.insert('cards',
-                    {'id': card['id'], 'set_name': set_name,
-                     'name': card['name'], 'layout': card['layout'],
-                     'mana_cost': card['manaCost'],
-                     'oracle_type': card['type'],
-                     'original_type': card['originalType'],
-                     'rarity': card['rarity'], 'oracle_text': card['text'],
-                     'original_text': card['originalText'],
-                     'flavor': card['flavor'], 'power': card['power'],
-                     'toughness': card['toughness'], 'cmc': card['cmc'],
-                     'loyalty': card['loyalty'], 'hand': card['hand'],
-                     'life': card['life'], 'use_multinames': 0})
-        insert_into_array_table('card_multinames', 'name', 'names')
-        insert_into_array_table('card_sets', 'set_name', 'printings')
-        insert_into_array_table('card_colors', 'color', 'colors')
-        insert_into_array_table('card_color_identities', 'color_identity',
-                                'colors')
-        insert_into_array_table('card_supertypes', 'supertype', 'supertypes')
-        insert_into_array_table('card_types', 'type', 'types')
-        insert_into_array_table('card_subtypes', 'subtype', 'subtypes')
-        if 'rulings' in card:
-            for ruling in card['rulings']:
-                self.insert('card_rulings',
-                            {'id': card['id'], 'date': ruling['date'],
-                             'text': ruling['text']})
-        if 'foreignNames' in card:
-            for foreign_name in card['foreignNames']:
-                self.insert('card_foreign_names',
-                            {'id': card['id'],
-                             'language': foreign_name['language'],
-                             'name': foreign_name['name']})
-        if 'legalities' in card:
-            for legality in card['legalities']:
-                self.insert('card_legalities',
-                            {'id': card['id'], 'format': legality['format'],
-                             'legality': legality['legality']})
-
 
 def get_translated_original_name(cursor, translation):
-    results = [(row[0], row[1]) for row in db.cursor.execute(
-               'SELECT id, language FROM card_foreign_names WHERE name = ?',
-               (translation,))]
-    if len(results) == 0:
-        print('Found no card translated to:', translation)
-    else:
-        used_name_language_combos = []
-        for result in results:
-            selected_id = result[0]
-            language = result[1]
-            cursor.execute('SELECT name FROM cards WHERE id = ?',
-                           (selected_id,))
-            name = cursor.fetchone()[0]
-            name_language_combo = language + ':' + name
-            if name_language_combo not in used_name_language_combos:
-                print('\'' + translation + '\' is the', language,
-                      'name for:', name)
-                used_name_language_combos += [name_language_combo]
-
-
-def get_card(cursor, card_name, card_set=None):
-    global args
+    output = ['\'' + translation + '\' is the ' + language +
+              ' name for: ' + name for language, name in
+              cursor.execute(translation_query,
+                             (normalize_name(translation),))]
+    if len(output) == 0:
+        return ['Found no card translated to: ' + translation]
+    return output
 
-    def print_card(card_id):
 
-        def multiline_text(text):
-            # TODO: Instead, check None below in the val resolution, as other
-            # fields may also be affected.
-            if text is not None:
-                return text.split('\n')
-            return []
-
-        def get_list(table, keys):
-            nonlocal card_id
-            rows = [row for row in cursor.execute(
-                    'SELECT ' + ','.join(keys) + ' FROM card_' + table +
-                    ' WHERE id=?', (card_id,))]
-            if len(keys) == 1:
-                return [row[0] for row in rows]
+def translate_deck_file(cursor, path):
+    # All card names of the deck are looked up at once, both as English and
+    # as translated names; lines keep their layout, with the card names
+    # replaced where the English name is unambiguous.
+    import re
+    import sys
+    entry_list, _ = parse_deck_file(path)
+    if entry_list is None:
+        return
+    with open(path, 'r') as f:
+        deck_lines = f.readlines()
+    cursor.execute('CREATE TEMP TABLE deck_names '
+                   '(norm_name PRIMARY KEY) WITHOUT ROWID')
+    cursor.executemany('INSERT OR IGNORE INTO deck_names VALUES (?)',
+                       [(normalize_name(entry.name),)
+                        for entry in entry_list])
+    english_names = {}
+    translations = {}
+    for norm_name, name in cursor.execute(
+            'SELECT d.norm_name, n.name FROM deck_names d '
+            'JOIN card_names n ON n.norm_name = d.norm_name'):
+        english_names[norm_name] = name
+    for norm_name, name in cursor.execute(
+            'SELECT d.norm_name, c.name FROM deck_names d '
+            'JOIN card_foreign_names f ON f.norm_name = d.norm_name '
+            'JOIN cards c ON c.id = f.id '
+            'GROUP BY d.norm_name, c.name ORDER BY min(f.rowid)'):
+        translations.setdefault(norm_name, []).append(name)
+    cursor.execute('DROP TABLE deck_names')
+    for i, line in enumerate(deck_lines):
+        match = re.match(r'^(\s*(?:SB:)?\s*\d+\s+)(\S.*?)(\s*)$', line)
+        if match is not None:
+            prefix, name, suffix = match.groups()
+            norm_name = normalize_name(name)
+            if norm_name in english_names:
+                name = english_names[norm_name]
+            elif len(translations.get(norm_name, [])) == 1:
+                name = translations[norm_name][0]
+            elif norm_name in translations:
+                print('Line ' + str(i + 1) + ': \'' + name + '\' is the '
+                      'translated name of more than one card: ' +
+                      ', '.join(translations[norm_name]), file=sys.stderr)
             else:
-                return [row[0] + ': ' + row[1] for row in rows]
+                print('Line ' + str(i + 1) + ': Found no card translated '
+                      'to: ' + name, file=sys.stderr)
+            line = prefix + name + suffix
+        sys.stdout.write(line)
+
+
+def create_deck_tables(cursor, entry_list):
+    # A deck's entries go into the deck_entries temp table, matched to card
+    # names; deck_cards holds the cards of each entry's default printing
+    # (both halves for split cards). drop_deck_tables() removes both again.
+    cursor.execute('CREATE TEMP TABLE deck_entries '
+                   '(name, norm_name, count, is_sideboard, card_name)')
+    cursor.executemany('INSERT INTO deck_entries (name, norm_name, count, '
+                       'is_sideboard) VALUES (?, ?, ?, ?)',
+                       [(entry.name, normalize_name(entry.name), entry.count,
+                         int(entry.is_sideboard)) for entry in entry_list])
+    # Names differing only in case or accents are taken as meant, as with -c.
+    cursor.execute('UPDATE deck_entries SET card_name = coalesce('
+                   '(SELECT name FROM card_defaults '
+                   'WHERE name = deck_entries.name), '
+                   '(SELECT min(name) FROM card_names '
+                   'WHERE norm_name = deck_entries.norm_name '
+                   'HAVING count(*) = 1))')
+    cursor.execute('CREATE TEMP TABLE deck_cards '
+                   '(entry, id, cmc, rarity, PRIMARY KEY (entry, id)) '
+                   'WITHOUT ROWID')
+    cursor.execute('INSERT OR IGNORE INTO deck_cards '
+                   'SELECT d.rowid, c.id, c.cmc, c.rarity '
+                   'FROM deck_entries d '
+                   'JOIN card_defaults p ON p.name = d.card_name '
+                   'LEFT JOIN card_multinames m ON p.use_multinames = 1 '
+                   'AND m.id = p.id LEFT JOIN card_printings q '
+                   'ON q.name = m.name AND q.set_name = p.set_name '
+                   'JOIN cards c ON c.id = coalesce(q.id, p.id)')
+
+
+def drop_deck_tables(cursor):
+    cursor.execute('DROP TABLE deck_cards')
+    cursor.execute('DROP TABLE deck_entries')
+
+
+def print_deck_stats(cursor, path):
+    # Each statistic is counted for main deck and sideboard at once by a
+    # single grouped query over the deck's temp tables.
+    entry_list, has_sideboard = parse_deck_file(path)
+    if entry_list is None:
+        return
+    create_deck_tables(cursor, entry_list)
+    boards = [(0, 'Main deck'), (1, 'Sideboard')] if has_sideboard \
+        else [(0, 'Main deck')]
+    totals = dict(cursor.execute('SELECT is_sideboard, sum(count) '
+                                 'FROM deck_entries GROUP BY is_sideboard'))
+    stats = {}
+    for title, values_query in deck_stats_queries:
+        for is_sideboard, value, count in cursor.execute(
+                'SELECT d.is_sideboard, v.value, sum(d.count) '
+                'FROM deck_entries d JOIN (' + values_query + ') v '
+                'ON v.entry = d.rowid GROUP BY d.is_sideboard, v.value '
+                'ORDER BY d.is_sideboard, v.value'):
+            stats.setdefault((is_sideboard, title), []).append((value,
+                                                                count))
+    unknown = cursor.execute('SELECT name, sum(count) FROM deck_entries '
+                             'WHERE card_name IS NULL GROUP BY name '
+                             'ORDER BY name').fetchall()
+    drop_deck_tables(cursor)
+    for is_sideboard, board in boards:
+        print(board + ': ' + str(totals.get(is_sideboard, 0)) + ' cards')
+        for title, _ in deck_stats_queries:
+            print('  ' + title + ':')
+            for value, count in stats.get((is_sideboard, title), []):
+                print('    ' + str(value) + ': ' + str(count))
+    if unknown:
+        print('Unknown cards:')
+        for name, count in unknown:
+            print('  ' + str(count) + ' ' + name)
+
+
+def check_legality(db, format_name, paths):
+    # Deck files are checked by a pool of worker processes, each with its
+    # own DB connection. The workers are forked rather than spawned, as this
+    # script cannot be imported without running it.
+    import multiprocessing
+    if db.cursor.execute('SELECT 1 FROM card_legalities '
+                         'WHERE format = ? COLLATE NOCASE LIMIT 1',
+                         (format_name,)).fetchone() is None:
+        print('Unknown format: ' + format_name)
+        return False
+    deck_paths = list_deck_files(paths)
+    all_legal = True
+    context = multiprocessing.get_context('fork')
+    with context.Pool(initializer=init_legality_worker,
+                      initargs=(db.sql_file, format_name)) as pool:
+        chunk_size = max(1, len(deck_paths) // (4 * os.cpu_count()))
+        for path, problems in pool.imap(check_deck_legality, deck_paths,
+                                        chunk_size):
+            all_legal = all_legal and not problems
+            print(path + ': ' + ('not legal' if problems else 'legal'))
+            for problem in problems:
+                print('  ' + problem)
+    return all_legal
+
+
+def list_deck_files(paths):
+    # Directories among paths stand for the (non-hidden) files in them.
+    deck_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            deck_paths += sorted([os.path.join(path, name)
+                                  for name in os.listdir(path)
+                                  if not name.startswith('.') and
+                                  os.path.isfile(os.path.join(path, name))])
+        else:
+            deck_paths += [path]
+    return deck_paths
 
-        def join_by_sep_rule(sep_rule, collection):
-            if sep_filter == 'indent':
-                return '\n'.join(['  ' + line for line in collection])
-            elif sep_filter == 'comma':
-                return ', '.join(collection)
 
-        nonlocal output
-        cursor.execute('SELECT name, layout, mana_cost, cmc, oracle_type, '
-                       'original_type, power, toughness, hand, life, flavor, '
-                       'oracle_text, original_text, rarity, id '
-                       'FROM cards WHERE id=?', (card_id,))
-        result = cursor.fetchone()
-        d = {
-            'name': result[0],
-            'names': get_list('multinames', ['name']),
-            'layout': result[1],
-            'mana_cost': str(result[2]),
-            'converted_mana_cost': str(result[3]),
-            'current_type': result[4],
-            'printed_type': result[5],
-            'power': str(result[6]),
-            'toughness': str(result[7]),
-            'max_hand_size_mod': str(result[8]),
-            'start_life_total_mod': str(result[9]),
-            'flavor': multiline_text(result[10]),
-            'oracle_text': multiline_text(result[11]),
-            'printed_text': multiline_text(result[12]),
-            'rarity': result[13],
-            'color': get_list('colors', ['color']),
-            'color_identity': get_list('color_identities', ['color_identity']),
-            'supertypes': get_list('supertypes', ['supertype']),
-            'types': get_list('types', ['type']),
-            'subtypes': get_list('subtypes', ['subtype']),
-            'sets': get_list('sets', ['set_name']),
-            'rulings': get_list('rulings', ['date', 'text']),
-            'legalities': get_list('legalities', ['format', 'legality']),
-            'foreign_names': get_list('foreign_names', ['language', 'name'])
-        }
-        global template
-        card_desc = template[:]
-        i_end = -1
-        while True:
-            i_start = card_desc.find('%', i_end + 1)
-            if i_start == -1:
-                break
-            i_end = card_desc.find('%', i_start + 1)
-            if i_end == -1:
+def parse_deck_file_quietly(path):
+    # For worker processes: returns parse_deck_file()'s entry list, and the
+    # lines of the messages it would have printed.
+    import contextlib
+    import io
+    messages = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(messages):
+            entry_list, _ = parse_deck_file(path)
+    except (OSError, UnicodeDecodeError) as err:
+        return None, ['Cannot read deck file: ' + str(err)]
+    return entry_list, messages.getvalue().splitlines()
+
+
+def init_legality_worker(sql_file, format_name):
+    global legality_cursor, legality_format
+    legality_cursor = sqlite3.connect(sql_file).cursor()
+    legality_format = format_name
+
+
+def check_deck_legality(path):
+    entry_list, messages = parse_deck_file_quietly(path)
+    if entry_list is None:
+        return path, messages
+    copy_limit = format_copy_limits.get(legality_format.lower(),
+                                        deck_copy_limit)
+    create_deck_tables(legality_cursor, entry_list)
+    problems = []
+    for name, count, legality, unlimited in legality_cursor.execute(
+            deck_legality_query, (legality_format,)).fetchall():
+        if legality is None:
+            problems += [name + ': unknown card']
+        elif legality == 3:
+            problems += [name + ': not legal in ' + legality_format]
+        elif legality == 2:
+            problems += [name + ': banned']
+        elif legality == 1 and count > 1:
+            problems += [name + ': restricted, ' + str(count) + ' copies']
+        elif count > copy_limit and not unlimited:
+            problems += [name + ': ' + str(count) + ' copies, more than ' +
+                         str(copy_limit)]
+    drop_deck_tables(legality_cursor)
+    return path, problems
+
+
+def resolve_decks(db, paths):
+    # Worker processes only parse the deck files; their entries are written
+    # to temp tables, which sqlite keeps on disk once they grow large, and
+    # only a batch of decks at a time is waited for, so memory use does not
+    # grow with the number of decks. The distinct card names of all decks
+    # are then resolved at once, and the reports read back in deck order.
+    import json
+    import multiprocessing
+    import sys
+    deck_paths = list_deck_files(paths)
+    db.cursor.execute('CREATE TEMP TABLE resolve_decks '
+                      '(path, messages)')
+    db.cursor.execute('CREATE TEMP TABLE resolve_deck_entries '
+                      '(deck INTEGER, name, norm_name, count, '
+                      'is_sideboard)')
+    context = multiprocessing.get_context('fork')
+    with context.Pool() as pool:
+        batch_size = 64 * os.cpu_count()
+        for i in range(0, len(deck_paths), batch_size):
+            batch = deck_paths[i:i + batch_size]
+            for path, entries, messages in pool.imap(
+                    parse_deck_file_for_resolving, batch,
+                    max(1, len(batch) // (4 * os.cpu_count()))):
+                db.cursor.execute('INSERT INTO resolve_decks VALUES (?, ?)',
+                                  (path, '\n'.join(messages)
+                                   if entries is None else None))
+                deck = db.cursor.lastrowid
+                db.cursor.executemany('INSERT INTO resolve_deck_entries '
+                                      'VALUES (?, ?, ?, ?, ?)',
+                                      [(deck,) + entry
+                                       for entry in entries or []])
+    db.cursor.execute('CREATE INDEX resolve_deck_entries_deck '
+                      'ON resolve_deck_entries (deck)')
+    # Names differing only in case or accents are taken as meant, as with -c.
+    db.cursor.execute('CREATE TEMP TABLE resolve_names '
+                      '(name PRIMARY KEY, card_name) WITHOUT ROWID')
+    db.cursor.execute('INSERT INTO resolve_names SELECT n.name, coalesce('
+                      '(SELECT name FROM card_defaults WHERE name = n.name), '
+                      '(SELECT min(name) FROM card_names '
+                      'WHERE norm_name = n.norm_name HAVING count(*) = 1)) '
+                      'FROM (SELECT name, min(norm_name) AS norm_name '
+                      'FROM resolve_deck_entries GROUP BY name) n')
+    report = None
+    report_deck = None
+    for deck, path, messages, name, count, is_sideboard, card_name, card_id \
+            in db.cursor.execute(
+                'SELECT d.rowid, d.path, d.messages, e.name, e.count, '
+                'e.is_sideboard, n.card_name, p.id FROM resolve_decks d '
+                'LEFT JOIN resolve_deck_entries e ON e.deck = d.rowid '
+                'LEFT JOIN resolve_names n ON n.name = e.name '
+                'LEFT JOIN card_defaults p ON p.name = n.card_name '
+                'ORDER BY d.rowid, e.rowid'):
+        if deck != report_deck:
+            if report is not None:
+                sys.stdout.write(json.dumps(report) + '\n')
+            report = {'deck': path}
+            report_deck = deck
+            if messages is not None:
+                report['error'] = messages
+                continue
+            report.update({'cards': 0, 'sideboard_cards': 0, 'entries': [],
+                           'unknown': []})
+        report['sideboard_cards' if is_sideboard else 'cards'] += count
+        report['entries'].append({'name': name, 'count': count,
+                                  'sideboard': bool(is_sideboard),
+                                  'card_name': card_name, 'id': card_id})
+        if card_name is None and name not in report['unknown']:
+            report['unknown'].append(name)
+    if report is not None:
+        sys.stdout.write(json.dumps(report) + '\n')
+    for table in ('resolve_names', 'resolve_deck_entries', 'resolve_decks'):
+        db.cursor.execute('DROP TABLE ' + table)
+
+
+def parse_deck_file_for_resolving(path):
+    entry_list, messages = parse_deck_file_quietly(path)
+    if entry_list is None:
+        return path, None, messages
+    return path, [(entry.name, normalize_name(entry.name), entry.count,
+                   int(entry.is_sideboard)) for entry in entry_list], messages
+
+
+class RenderCache:
+    # Rendered card data per card id and compiled template, kept across runs
+    # in an sqlite file next to the card DB. Entries belong to one build of
+    # the card DB and are dropped once another one replaces it; beyond
+    # render_cache_size bytes of rendered text, the least recently used ones
+    # are dropped, with use times only kept to the hour. All changes are
+    # gathered and written by close() in one go, so that many runs can share
+    # the cache without waiting for each other's write locks.
+
+    def __init__(self, db):
+        import time
+        self.conn = sqlite3.connect(db.db_dir + 'render_cache.sqlite',
+                                    timeout=30)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('PRAGMA journal_mode = WAL')
+        self.cursor.execute('PRAGMA synchronous = NORMAL')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS renders ('
+                            'card_id, '
+                            'template_hash, '
+                            'lines, '
+                            'size, '
+                            'last_used, '
+                            'PRIMARY KEY (card_id, template_hash)) '
+                            'WITHOUT ROWID')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS renders_last_used '
+                            'ON renders (last_used)')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS stats ('
+                            'name PRIMARY KEY, '
+                            'value) WITHOUT ROWID')
+        self.conn.commit()
+        self.build_fingerprint = db.build_fingerprint
+        self.is_current = self.get_stats().get('build_fingerprint') == \
+            self.build_fingerprint
+        self.now = int(time.time()) // 3600
+        self.template_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.added = {}
+
+    def get_stats(self):
+        return dict(self.cursor.execute('SELECT name, value FROM stats'))
+
+    def template_hash(self, parts):
+        # compile_template() returns the same parts for the same template,
+        # which are kept here along with the hash, so their id stays theirs.
+        import hashlib
+        if id(parts) not in self.template_hashes:
+            self.template_hashes[id(parts)] = \
+                parts, hashlib.sha1(repr(parts).encode()).hexdigest()
+        return self.template_hashes[id(parts)][1]
+
+    def get(self, card_id, parts):
+        key = (card_id, self.template_hash(parts))
+        if key in self.added:
+            self.hits += 1
+            return self.added[key]
+        result = None
+        if self.is_current:
+            result = self.cursor.execute('SELECT lines, last_used '
+                                         'FROM renders WHERE card_id = ? '
+                                         'AND template_hash = ?',
+                                         key).fetchone()
+        if result is None:
+            self.misses += 1
+            return None
+        lines, last_used = result
+        if last_used != self.now:
+            self.used.add(key)
+        self.hits += 1
+        return lines.split('\n')
+
+    def put(self, card_id, parts, lines):
+        self.added[(card_id, self.template_hash(parts))] = lines
+
+    def close(self):
+        self.cursor.execute('BEGIN IMMEDIATE')
+        stats = self.get_stats()
+        if stats.get('build_fingerprint') != self.build_fingerprint:
+            self.cursor.execute('DELETE FROM renders')
+            stats['build_fingerprint'] = self.build_fingerprint
+            stats['size'] = 0
+        added = []
+        for key, lines in self.added.items():
+            lines = '\n'.join(lines)
+            added += [key + (lines, len(lines.encode()), self.now)]
+        self.cursor.executemany('INSERT OR REPLACE INTO renders '
+                                'VALUES (?, ?, ?, ?, ?)', added)
+        stats['size'] = stats.get('size', 0) + \
+            sum([row[3] for row in added])
+        self.cursor.executemany('UPDATE renders SET last_used = ? '
+                                'WHERE card_id = ? AND template_hash = ?',
+                                [(self.now,) + key for key in self.used])
+        if stats['size'] > render_cache_size:
+            # Evicting down to less than the limit leaves room for a few
+            # more runs before the next eviction.
+            self.cursor.execute(
+                'DELETE FROM renders WHERE (card_id, template_hash) IN '
+                '(SELECT card_id, template_hash FROM (SELECT card_id, '
+                'template_hash, sum(size) OVER (ORDER BY last_used DESC '
+                'ROWS UNBOUNDED PRECEDING) AS total FROM renders) '
+                'WHERE total > ?)', (render_cache_size * 3 // 4,))
+            stats['size'] = self.cursor.execute(
+                'SELECT coalesce(sum(size), 0) FROM renders').fetchone()[0]
+        stats['hits'] = stats.get('hits', 0) + self.hits
+        stats['misses'] = stats.get('misses', 0) + self.misses
+        self.cursor.executemany('INSERT OR REPLACE INTO stats VALUES (?, ?)',
+                                list(stats.items()))
+        self.conn.commit()
+        self.conn.close()
+
+
+class NameIndex:
+    # The name index written by write_name_index(), mapped into memory, so a
+    # lookup only reads the few records its binary search visits. If the
+    # index is missing or belongs to another build of the DB, is_current is
+    # false.
+
+    def __init__(self, db_dir):
+        import mmap
+        import struct
+        self.is_current = False
+        try:
+            with open(db_dir + 'names.idx', 'rb') as f:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            fingerprint = db_file_fingerprint(db_dir + 'db.sqlite')
+        except (OSError, ValueError):
+            return
+        header_size = struct.calcsize(name_index_format)
+        if len(self.index) < header_size:
+            return
+        magic, version, self.count, index_fingerprint = \
+            struct.unpack_from(name_index_format, self.index)
+        self.records_start = header_size + 4 * (self.count + 1)
+        self.is_current = magic == name_index_magic and \
+            version == name_index_version and \
+            index_fingerprint.rstrip(b'\0') == fingerprint.encode() and \
+            len(self.index) >= self.records_start
+        if self.is_current:
+            self.offsets = memoryview(self.index)[
+                header_size:self.records_start].cast('I')
+
+    def get_record(self, i):
+        start = self.records_start
+        return self.index[start + self.offsets[i]:
+                          start + self.offsets[i + 1]].split(b'\0')
+
+    def find(self, norm_name, prefix=False):
+        # Names and default printing ids of the cards whose normalized name
+        # is norm_name, or starts with it, in normalized name order.
+        key = norm_name.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_record(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        matches = []
+        for i in range(low, self.count):
+            record_norm_name, name, card_id = self.get_record(i)
+            if not (record_norm_name.startswith(key) if prefix else
+                    record_norm_name == key):
                 break
-            i_filter = card_desc.find('|', i_start + 1)
-            sep_filter = 'comma'
-            var_name = ''
-            if i_filter > -1 and i_filter < i_end:
-                var_name = card_desc[i_start + 1:i_filter]
-                sep_filter = card_desc[i_filter + 1:i_end]
+            matches += [(name.decode(), card_id.decode())]
+        return matches
+
+
+def print_name_lookup(name=None, prefix=None):
+    # Prints name and default printing id of the card of the given name, or
+    # of all cards whose name starts with prefix, both as normalized. For a
+    # name, an exact match is taken over others, as get_card() does. The DB
+    # is only opened if the name index is not current; it is then rewritten.
+    # Returns whether there were matches.
+    norm_name = normalize_name(prefix if name is None else name)
+    if name is None and prefix[-1:].isspace():
+        norm_name += ' '
+    index = NameIndex(os.getenv('HOME') + '/.mtgtool/')
+    if index.is_current:
+        matches = index.find(norm_name, name is None)
+    else:
+        db = DB()
+        matches = find_card_names(db.cursor, norm_name, name is None)
+        write_name_index(db.name_index_file, db.cursor.execute(
+            name_index_query.format('')).fetchall(), db.build_fingerprint)
+        db.conn.close()
+    if name is not None:
+        exact_matches = [match for match in matches if match[0] == name]
+        matches = exact_matches or (matches if len(matches) == 1 else [])
+    for match in matches:
+        print('\t'.join(match))
+    return len(matches) > 0
+
+
+def get_card(cursor, card_name, card_set=None, templ=None, quiet=None,
+             cache=None):
+    import json
+    global args
+    if templ is None:
+        templ = template
+    if quiet is None:
+        quiet = args.quiet
+
+    def print_card(card_id):
+        nonlocal output
+        if cache is not None:
+            lines = cache.get(card_id, parts)
+            if lines is not None:
+                output += lines
+                return
+        d = {}
+        if fields:
+            cursor.execute('SELECT ' + ', '.join(fields) +
+                           ' FROM card_records WHERE id=?', (card_id,))
+            d = dict(zip(fields, cursor.fetchone()))
+        card_desc = []
+        for part in parts:
+            if type(part) is str:
+                card_desc += [part]
+                continue
+            var_name, sep_filter = part
+            val = d[var_name]
+            if var_name in ('flavor', 'oracle_text', 'printed_text'):
+                val = val.split('\n') if val is not None else []
+            elif var_name in card_record_list_fields:
+                val = json.loads(val)
             else:
-                var_name = card_desc[i_start + 1:i_end]
-            if var_name == '':
-                val = '%'
+                card_desc += [str(val)]
+                continue
+            if sep_filter == 'indent':
+                card_desc += ['\n'.join(['  ' + line for line in val])]
             else:
-                val = d[var_name]
-                if type(val) is list:
-                    val = join_by_sep_rule(sep_filter, val)
-            card_desc_start = card_desc[:i_start] + val
-            card_desc = card_desc_start + card_desc[i_end+1:]
-            i_end = len(card_desc_start) - 1
-        output += card_desc.split('\n')
-
-    sorted_sets = [row[0] for row in
-                   cursor.execute('SELECT name FROM sets ORDER BY date')]
-    results = [{'set': row[0], 'id': row[1], 'use_multinames': row[2]}
-               for row in
-               cursor.execute('SELECT set_name, id, use_multinames '
-               'FROM cards WHERE name=?', (card_name,))]
-    if 0 == len(results):
-        return ['Unknown card: ' + card_name]
-    set_name = results[0]['set']
-    sets_of_card = [result['set'] for result in results]
-    card_choice = 0
+                card_desc += [', '.join(val)]
+        lines = ''.join(card_desc).split('\n')
+        if cache is not None:
+            cache.put(card_id, parts, lines)
+        output += lines
+
+    parts, fields = compile_template(templ)
     output = []
+    cursor.execute('SELECT set_name, id, use_multinames, card_count '
+                   'FROM card_defaults WHERE name=?', (card_name,))
+    result = cursor.fetchone()
+    if result is None:
+        # Names differing only in case or accents are taken as meant.
+        matches = cursor.execute('SELECT name FROM card_names '
+                                 'WHERE norm_name=?',
+                                 (normalize_name(card_name),)).fetchall()
+        if len(matches) == 1:
+            return get_card(cursor, matches[0][0], card_set, templ, quiet,
+                            cache)
+        suggestions = suggest_card_names(cursor, card_name)
+        if not suggestions:
+            return ['Unknown card: ' + card_name]
+        return ['Unknown card: ' + card_name, 'Did you mean:'] + \
+            ['  ' + name for name in suggestions]
+    set_name, selected_id, use_multinames, card_count = result
     if card_set is not None:
-        if card_set not in sets_of_card:
+        cursor.execute('SELECT id, use_multinames FROM card_printings '
+                       'WHERE name=? AND set_name=?', (card_name, card_set))
+        result = cursor.fetchone()
+        if result is None:
             return ['Set ' + card_set +
                     ' not among sets this card is featured in.']
         set_name = card_set
-        card_choice = sets_of_card.index(set_name)
-    elif len(results) > 1:
-        for set_name_i in sorted_sets:
-            if set_name_i in sets_of_card:
-                set_name = set_name_i
-        card_choice = sets_of_card.index(set_name)
-        if not args.quiet:
-            output += ['There are multiple printings of this card in '
-                       'different sets. Showing the printing of newest set: ' +
-                       set_name]
-    selected_id = results[card_choice]['id']
-    use_multinames = results[card_choice]['use_multinames']
+        selected_id, use_multinames = result
+    elif card_count > 1 and not quiet:
+        output += ['There are multiple printings of this card in '
+                   'different sets. Showing the printing of newest set: ' +
+                   set_name]
     if 1 == use_multinames:
         names = [row[0] for row in
                  cursor.execute('SELECT name FROM card_multinames '
                                 'WHERE id=?', (selected_id,))]
-        if not args.quiet:
+        if not quiet:
             output += ['Card is split:']
         for name in names:
             output += ['//']
@@ -425,37 +1871,322 @@ def get_card(cursor, card_name, card_set=None):
     return output
 
 
+def print_cards_batch(cursor, batch_file, separator, cache=None):
+    import sys
+    for line in batch_file:
+        card_name, _, card_set = line.partition('\t')
+        card_name = card_name.strip()
+        card_set = card_set.strip()
+        if card_name == '':
+            continue
+        output = get_card(cursor, card_name,
+                          card_set if card_set != '' else None, cache=cache)
+        sys.stdout.write('\n'.join(output) + '\n' + separator)
+
+
+def compile_search(cursor, query):
+    # Filter terms like "cmc<=2" or "type:Instant" become conditions on the
+    # filter's table; whatever remains of the query is passed on as FTS5
+    # query on the card texts. All are combined into a single statement,
+    # which yields per matching card name the newest matching printing.
+    # sqlite cannot tell which filter matches the fewest cards, and reading
+    # the cards of a filter like legal:Legacy and dropping nearly all of
+    # them again takes long; so each filter is first probed for its number
+    # of matches (up to a limit), and only the filter with the fewest is
+    # used to look up cards, the others are checked per found card.
+    import re
+    filters = []
+
+    def compile_filter(match):
+        key, operator, value = match.groups()
+        if value.startswith('"'):
+            value = value[1:-1]
+        table, condition = search_filters[key]
+        if key == 'cmc':
+            if operator == ':':
+                operator = '='
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError('Not a number: ' + value)
+            condition = condition.format(operator)
+        elif operator != ':':
+            raise ValueError('Operator ' + operator + ' illegal for ' + key +
+                             ', use ' + key + ':')
+        filters.append((table, condition, value))
+        return ' '
+
+    text_query = re.sub(r'(?<!\S)(' + '|'.join(search_filters) +
+                        r')(<=|>=|!=|=|<|>|:)("[^"]*"|[^\s"]+)',
+                        compile_filter, query).strip()
+    if text_query:
+        filters.append(('card_texts', 'card_texts MATCH ?', text_query))
+    if not filters:
+        raise ValueError('Empty search query.')
+    counts = [cursor.execute('SELECT count(*) FROM (SELECT 1 FROM ' + table +
+                             ' WHERE ' + condition + ' LIMIT 10000)',
+                             (value,)).fetchone()[0]
+              for table, condition, value in filters]
+    filters.insert(0, filters.pop(counts.index(min(counts))))
+    conditions = []
+    for table, condition, _ in filters:
+        key = 'rowid' if table in ('cards', 'card_texts') else 'id'
+        if not conditions:
+            conditions.append('c.' + key + ' IN (SELECT ' + key + ' FROM ' +
+                              table + ' WHERE ' + condition + ')')
+        else:
+            conditions.append('EXISTS (SELECT 1 FROM ' + table + ' WHERE ' +
+                              key + ' = c.' + key + ' AND ' + condition + ')')
+    return ('SELECT c.name, c.set_name, max(p.position) FROM cards c '
+            'JOIN card_printings p ON p.name = c.name '
+            'AND p.set_name = c.set_name WHERE ' +
+            ' AND '.join(conditions) + ' GROUP BY c.name ORDER BY c.name',
+            [value for _, _, value in filters])
+
+
+def print_cards_search(cursor, query, separator, cache=None):
+    import sys
+    try:
+        sql, params = compile_search(cursor, query)
+        # Another cursor, as get_card() uses this one while results come in.
+        results = cursor.connection.execute(sql, params)
+        found = False
+        for name, set_name, _ in results:
+            found = True
+            output = get_card(cursor, name, set_name, cache=cache)
+            sys.stdout.write('\n'.join(output) + '\n' + separator)
+    except (ValueError, sqlite3.OperationalError) as err:
+        print('Bad search query:', err)
+        return
+    if not found:
+        print_verbose('No cards found.')
+
+
+def serve(db):
+    import collections
+    import json
+    import queue
+    import signal
+    import socketserver
+    import sys
+    import threading
+    import time
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        commands = ('card', 'stats', 'translate')
+
+        def __init__(self):
+            self.connections = queue.LifoQueue()
+            self.latencies = {}
+            self.latencies_lock = threading.Lock()
+            super().__init__(server_socket_path(), RequestHandler)
+
+        def get_connection(self):
+            # A DB rebuild swaps in a new DB file; connections opened on the
+            # old one are then dropped instead of reused.
+            db_inode = os.stat(db.sql_file).st_ino
+            while True:
+                try:
+                    inode, conn = self.connections.get_nowait()
+                except queue.Empty:
+                    conn = sqlite3.connect(db.sql_file,
+                                           check_same_thread=False)
+                    return db_inode, conn
+                if inode == db_inode:
+                    return inode, conn
+                conn.close()
+
+        def handle_request(self, request):
+            # Requests come from other processes, so anything but a known
+            # command with string arguments is turned down.
+            if not isinstance(request, dict):
+                raise ValueError('Request is not a JSON object.')
+            command = request.get('command')
+            if command not in self.commands:
+                raise ValueError('Unknown command: ' + str(command))
+            if command != 'stats' and not isinstance(request.get('name'),
+                                                     str):
+                raise ValueError('Card name is not a string.')
+            for key in ('set', 'template'):
+                if not isinstance(request.get(key, ''), (str, type(None))):
+                    raise ValueError('Card ' + key + ' is not a string.')
+            if command == 'stats':
+                return self.get_stats()
+            inode, conn = self.get_connection()
+            try:
+                if command == 'card':
+                    templ = request.get('template', template)
+                    err = template_error(templ)
+                    if err:
+                        raise ValueError(err)
+                    return get_card(conn.cursor(), request['name'],
+                                    request.get('set'), templ,
+                                    request.get('quiet', False))
+                elif command == 'translate':
+                    return get_translated_original_name(conn.cursor(),
+                                                        request['name'])
+            finally:
+                self.connections.put((inode, conn))
+
+        def add_latency(self, command, seconds):
+            with self.latencies_lock:
+                if command not in self.latencies:
+                    self.latencies[command] = [0, 0.0, 0.0,
+                                               collections.deque(maxlen=1000)]
+                stats = self.latencies[command]
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+                stats[3].append(seconds)
+
+        def get_stats(self):
+            lines = []
+            with self.latencies_lock:
+                for command in sorted(self.latencies):
+                    count, total, maximum, recent = self.latencies[command]
+                    recent = sorted(recent)
+                    lines += ['%s: %d requests, mean %.2f ms, max %.2f ms, '
+                              'last %d: median %.2f ms, 95th percentile '
+                              '%.2f ms' %
+                              (command, count, 1000 * total / count,
+                               1000 * maximum, len(recent),
+                               1000 * recent[len(recent) // 2],
+                               1000 * recent[len(recent) * 95 // 100])]
+            return lines
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            for line in self.rfile:
+                time_start = time.perf_counter()
+                request = None
+                try:
+                    request = json.loads(line)
+                    response = {'ok': True,
+                                'lines': self.server.handle_request(request)}
+                except (ValueError, KeyError, TypeError) as err:
+                    response = {'ok': False, 'error': str(err)}
+                self.wfile.write((json.dumps(response) + '\n').encode())
+                # Only requests of known commands count in the stats.
+                if isinstance(request, dict) and \
+                        request.get('command') in self.server.commands:
+                    self.server.add_latency(request['command'],
+                                            time.perf_counter() - time_start)
+
+    if ask_server({'command': 'stats'}) is not None:
+        print('Server already running at', server_socket_path())
+        return
+    if os.path.exists(server_socket_path()):
+        os.remove(server_socket_path())
+    server = Server()
+    print_verbose('Serving card lookups at ' + server_socket_path() + ' …')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(server_socket_path())
+
+
+def server_socket_path():
+    return os.getenv('HOME') + '/.mtgtool/socket'
+
+
+def ask_server(request):
+    # Returns the response of a running --serve process to request, or None
+    # if there is no such process.
+    import json
+    import socket
+    if not os.path.exists(server_socket_path()):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(server_socket_path())
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('r', encoding='utf-8') as sock_file:
+                response = sock_file.readline()
+    except OSError:
+        return None
+    if response == '':
+        return None
+    return json.loads(response)
+
+
 def browse_cards(stdscr, db, entry_list, has_sideboard):
 
     class CardCollection:
+        # Card descriptions are rendered ahead by a few worker threads, each
+        # with its own DB connection, starting with the entries nearest to
+        # the list focus. Only the most recently used ones are kept.
+        prefetch_workers = 2
+        prefetch_radius = 200
+        cache_size = 1000
 
         def __init__(self, db, entry_list, has_sideboard):
+            import collections
             import threading
-
-            def collect_cards(db, names, descs):
-                conn = sqlite3.connect(db.sql_file)
-                cursor = conn.cursor()
-                for name in names:
-                    if name not in descs:
-                        descs[name] = get_card(cursor, name)
-                conn.close()
-
             self.db = db
             self.have_sideboard = has_sideboard
             entry_list.sort(key=lambda card: card.name)
             entry_list.sort(key=lambda card: card.is_sideboard)
             self.entry_list = entry_list
-            self.descriptions = {}
-            names = [entry.name for entry in self.entry_list]
-            t = threading.Thread(target=collect_cards, daemon=True,
-                                 kwargs={'db': self.db, 'names': names,
-                                         'descs': self.descriptions})
-            t.start()
+            self.descriptions = collections.OrderedDict()
+            self._rendering = set()
+            self._focus = 0
+            self._changed = threading.Condition()
+            for _ in range(self.prefetch_workers):
+                threading.Thread(target=self._prefetch, daemon=True).start()
+
+        def _next_name(self):
+            for distance in range(self.prefetch_radius + 1):
+                for i in (self._focus + distance, self._focus - distance):
+                    if 0 <= i < len(self.entry_list):
+                        name = self.entry_list[i].name
+                        if name not in self.descriptions and \
+                                name not in self._rendering:
+                            return name
+            return None
+
+        def _prefetch(self):
+            conn = sqlite3.connect(self.db.sql_file)
+            cursor = conn.cursor()
+            while True:
+                with self._changed:
+                    name = self._next_name()
+                    while name is None:
+                        self._changed.wait()
+                        name = self._next_name()
+                    self._rendering.add(name)
+                card_desc = get_card(cursor, name)
+                with self._changed:
+                    self._rendering.discard(name)
+                    self._store(name, card_desc)
+
+        def _store(self, name, card_desc):
+            self.descriptions[name] = card_desc
+            self.descriptions.move_to_end(name)
+            while len(self.descriptions) > self.cache_size:
+                self.descriptions.popitem(last=False)
+
+        def set_focus(self, index):
+            with self._changed:
+                self._focus = index
+                self._changed.notify_all()
 
         def get_card_desc(self, name):
-            if name not in self.descriptions:
-                self.descriptions[name] = get_card(self.db.cursor, name)
-            return self.descriptions[name]
+            with self._changed:
+                if name in self.descriptions:
+                    self.descriptions.move_to_end(name)
+                    return self.descriptions[name]
+            # Rendered right here instead of waiting for the workers, which
+            # may be busy with other cards.
+            card_desc = get_card(self.db.cursor, name)
+            with self._changed:
+                self._store(name, card_desc)
+            return card_desc
 
     class Pane:
 
@@ -463,97 +2194,137 @@ def browse_cards(stdscr, db, entry_list, has_sideboard):
             self._start_x = 0
             self.scroll_offset = 0
 
-        def draw(self):
-            self._pad.clear()
-            self._draw_content()
-            if self.scroll_offset != 0:
-                self._pad.addstr(self.scroll_offset, 0,
-                                 '^'*self._win_width, curses.A_REVERSE)
-            if self._pad_height - self._win_height > self.scroll_offset:
-                self._pad.addstr(self.scroll_offset + self._win_height - 1, 0,
-                                 self._win_width*'v', curses.A_REVERSE)
-            self._pad.noutrefresh(self.scroll_offset, 0,
-                                  0, self._start_x,
-                                  self._win_height - 1,
-                                  self._start_x + self._win_width - 1)
-
     class CardListFrame(Pane):
+        # Only the entries in view are written to the window, and of those
+        # only the rows that changed since the last draw: all of them after
+        # scrolling, else just those that lost or gained the focus.
 
         def __init__(self, win_width, win_height, entry_list, has_sideboard):
             super().__init__()
             self._has_sideboard = has_sideboard
             self._entry_list = entry_list
             self._win_width = win_width
-            self._pad_height = len(self._entry_list)
+            self._list_height = len(self._entry_list)
             self._count_width = max([len(str(entry.count))
                                     for entry in self._entry_list])
             self._line_focus = 0
+            self.selected_index = 0
             self.set_geometry(win_height)
-            self._pad = curses.newpad(self._pad_height, self._win_width)
 
         def set_geometry(self, win_height):
             self._win_height = win_height - 1
             self._scroll_start = self._win_height // 2
             self._scroll_end = max(0,
-                                   self._pad_height - (self._win_height //
-                                                       2) - 1)
+                                   self._list_height - (self._win_height //
+                                                        2) - 1)
             self.selected_card = self._entry_list[self._line_focus].name
             self._scroll()
+            self._win = curses.newwin(self._win_height, self._win_width, 0,
+                                      self._start_x)
+            self._drawn_offset = None
+            self._dirty_lines = set()
 
         def _scroll(self):
-            if self._win_height >= self._pad_height or \
+            if self._win_height >= self._list_height or \
                     self._line_focus < self._scroll_start:
                 self.scroll_offset = 0
             elif self._line_focus > self._scroll_end:
-                self.scroll_offset = self._pad_height - self._win_height
+                self.scroll_offset = self._list_height - self._win_height
             else:
                 self.scroll_offset = self._line_focus - (self._win_height // 2)
 
+        def _move_focus(self, line_focus):
+            self._dirty_lines.update((self._line_focus, line_focus))
+            self._line_focus = line_focus
+            self.selected_index = self._line_focus
+            self.selected_card = self._entry_list[self._line_focus].name
+            self._scroll()
+
         def move_up(self):
             if self._line_focus > 0:
-                self._line_focus -= 1
-                self.selected_card = self._entry_list[self._line_focus].name
-                self._scroll()
+                self._move_focus(self._line_focus - 1)
 
         def move_down(self):
-            if self._line_focus < self._pad_height - 1:
-                self._line_focus += 1
-                self.selected_card = self._entry_list[self._line_focus].name
-                self._scroll()
-
-        def _draw_content(self, *args):
-            for i in range(self._pad_height):
-                if i == self._line_focus:
-                    attr = curses.A_REVERSE
-                else:
-                    attr = curses.A_NORMAL
-                card_name = self._entry_list[i].name
-                count_str = str(self._entry_list[i].count)
-                count_pad = self._count_width - len(count_str)
-                sideboard_prefix = ''
-                if self._has_sideboard:
-                    sideboard_prefix = '    '
-                    if self._entry_list[i].is_sideboard:
-                        sideboard_prefix = 'SB: '
-                line = sideboard_prefix + ' ' * count_pad + count_str + ' ' + \
-                    card_name
-                if len(line) > self._win_width:
-                    line = line[0:self._win_width - 1] + '…'
-                self._pad.addstr(i, 0, line, attr)
+            if self._line_focus < self._list_height - 1:
+                self._move_focus(self._line_focus + 1)
+
+        def draw(self):
+            if self._drawn_offset != self.scroll_offset:
+                rows = range(self._win_height)
+            else:
+                rows = [i - self.scroll_offset for i in self._dirty_lines
+                        if 0 <= i - self.scroll_offset < self._win_height]
+            for row in rows:
+                self._draw_row(row)
+            self._drawn_offset = self.scroll_offset
+            self._dirty_lines.clear()
+            self._win.noutrefresh()
+
+        def _draw_row(self, row):
+            # insstr() instead of addstr(), as the latter fails on writing
+            # the window's bottom right corner.
+            self._win.move(row, 0)
+            self._win.clrtoeol()
+            if row == 0 and self.scroll_offset != 0:
+                self._win.insstr(row, 0, '^'*self._win_width,
+                                 curses.A_REVERSE)
+                return
+            if row == self._win_height - 1 and \
+                    self._list_height - self._win_height > self.scroll_offset:
+                self._win.insstr(row, 0, self._win_width*'v',
+                                 curses.A_REVERSE)
+                return
+            i = self.scroll_offset + row
+            if i >= self._list_height:
+                return
+            if i == self._line_focus:
+                attr = curses.A_REVERSE
+            else:
+                attr = curses.A_NORMAL
+            card_name = self._entry_list[i].name
+            count_str = str(self._entry_list[i].count)
+            count_pad = self._count_width - len(count_str)
+            sideboard_prefix = ''
+            if self._has_sideboard:
+                sideboard_prefix = '    '
+                if self._entry_list[i].is_sideboard:
+                    sideboard_prefix = 'SB: '
+            line = sideboard_prefix + ' ' * count_pad + count_str + ' ' + \
+                card_name
+            if len(line) > self._win_width:
+                line = line[0:self._win_width - 1] + '…'
+            self._win.insstr(row, 0, line, attr)
 
     class CardDescFrame(Pane):
+        # Measuring the display width of every character of a description is
+        # slow, so its wrapped layout is only written to the pad anew for
+        # another card or pane size; scrolling just shows another part of
+        # the pad. The scroll arrows are drawn in windows of their own on top
+        # of the pad, so they never overwrite its content.
 
         def __init__(self, start_x, win_width, win_height):
             super().__init__()
             self._start_x = start_x
             self._pad_height = 1
+            self._layout_key = None
+            self._card_name = None
             self.set_geometry(win_height, win_width)
             self._pad = curses.newpad(self._pad_height, self._win_width)
 
         def set_geometry(self, win_height, win_width):
             self._win_height = win_height - 1
             self._win_width = win_width - self._start_x
-            if hasattr(self, '_card_desc'):
+            self._top_arrow = curses.newwin(1, self._win_width, 0,
+                                            self._start_x)
+            self._top_arrow.insstr(0, 0, '^' * self._win_width,
+                                   curses.A_REVERSE)
+            self._bottom_arrow = curses.newwin(1, self._win_width,
+                                               self._win_height - 1,
+                                               self._start_x)
+            self._bottom_arrow.insstr(0, 0, 'v' * self._win_width,
+                                      curses.A_REVERSE)
+            self._layout_key = None
+            if self._card_name is not None:
                 self._draw_content()
             if self.scroll_offset != 0:
                 if self._win_height >= self._pad_height:
@@ -561,7 +2332,8 @@ def browse_cards(stdscr, db, entry_list, has_sideboard):
                 elif self.scroll_offset > self._pad_height - self._win_height:
                     self.scroll_offset = self._pad_height - self._win_height
 
-        def set_desc(self, card_desc):
+        def set_desc(self, card_name, card_desc):
+            self._card_name = card_name
             self._card_desc = card_desc
 
         def scroll_up(self):
@@ -572,6 +2344,23 @@ def browse_cards(stdscr, db, entry_list, has_sideboard):
             if self.scroll_offset < self._pad_height - self._win_height:
                 self.scroll_offset += 1
 
+        def draw(self):
+            if self._layout_key != (self._card_name, self._win_width):
+                self._draw_content()
+            # Unchanged pad lines are not copied to the screen otherwise, as
+            # needed after scrolling, or where an arrow went away.
+            self._pad.touchwin()
+            self._pad.noutrefresh(self.scroll_offset, 0,
+                                  0, self._start_x,
+                                  self._win_height - 1,
+                                  self._start_x + self._win_width - 1)
+            if self.scroll_offset != 0:
+                self._top_arrow.touchwin()
+                self._top_arrow.noutrefresh()
+            if self._pad_height - self._win_height > self.scroll_offset:
+                self._bottom_arrow.touchwin()
+                self._bottom_arrow.noutrefresh()
+
         def _draw_content(self):
             import unicodedata
             card_desc_lines = self._card_desc[:]
@@ -592,8 +2381,10 @@ def browse_cards(stdscr, db, entry_list, has_sideboard):
                 fixed_lines += [line]
             content = ''.join(fixed_lines)
             self._pad_height = max(self._win_height, height)
+            self._pad.erase()
             self._pad.resize(self._pad_height + 1, self._win_width)
             self._pad.addstr(0, 0, content)
+            self._layout_key = (self._card_name, self._win_width)
 
     class Window:
 
@@ -649,9 +2440,10 @@ def browse_cards(stdscr, db, entry_list, has_sideboard):
 
         def draw_frame_insides(self):
             self._card_list.draw()
+            self._card_coll.set_focus(self._card_list.selected_index)
             card_name = self._card_list.selected_card
             card_desc = self._card_coll.get_card_desc(card_name)
-            self._card_desc.set_desc(card_desc)
+            self._card_desc.set_desc(card_name, card_desc)
             self._card_desc.draw()
             curses.doupdate()
 
@@ -702,104 +2494,104 @@ class DeckEntry():
 
 
 def parse_deck_file(path):
+    # Both formats are checked in the same single pass over the file, with
+    # one regex telling apart the kinds of lines either format accepts, and
+    # card counts summed up per (name, sideboard) in a dict.
     import re
-
-    def check_lines_by_regex(deck_lines, regex_correctness):
-        for i in range(len(deck_lines)):
-            if re.match(regex_correctness, deck_lines[i]) is None:
-                return 'Deck file malformed on line ' + str(i + 1)
-        return None
-
-    def add_match_to_entry_list(entry_list, matches, is_sideboarded):
-        count = int(matches[1])
-        name = matches[2]
-        is_new = True
-        for i in range(len(entry_list)):
-            entry = entry_list[i]
-            if entry.name == name and entry.is_sideboard == is_sideboarded:
-                entry_list[i].count += count
-                is_new = False
-        if is_new:
-            entry_list += [DeckEntry(name, count, is_sideboarded)]
-
-    def try_format_1():
-        # Test correctness.
-        regex_correctness = r'^\s*(//.*|(SB:)?\s*\d+\s+\S.*)?$'
-        err = check_lines_by_regex(deck_lines, regex_correctness)
-        if err:
-            return None, None, 'Format 1: Error: ' + err
-        # Parse.
-        regex_capture = r'^\s*(//.*|(SB:)?\s*(\d+)\s+(\S.*?)\s*)?$'
-        entry_list = []
-        has_sideboard = False
-        for line in deck_lines:
-            matches = re.match(regex_capture, line).group(2, 3, 4)
-            if matches[1] is None:
-                continue
-            is_sideboard = matches[0] is not None
-            has_sideboard = True if is_sideboard else has_sideboard
-            add_match_to_entry_list(entry_list, matches, is_sideboard)
-        return entry_list, has_sideboard, ''
-
-    def try_format_2():
-        # Test correctness.
-        err_prefix = 'Format 2: Error: '
-        regex_correctness = r'^\s*(//.*|Sideboard\s*|\d+\s+\S.*)?$'
-        err = check_lines_by_regex(deck_lines, regex_correctness)
-        if err:
-            return None, None, err_prefix + err
-        regex_capture = r'^\s*(//.*|(Sideboard\s*)|(\d+)\s+(\S.*?)\s*)?$'
-        has_sideboard = False
-        sideboard_empty = True
-        for line in deck_lines:
-            matches = re.match(regex_capture, line).group(2, 3, 4)
-            if matches[0] is not None:
-                if has_sideboard:
-                    return None, None, err_prefix +\
-                           'More than one "Sideboard" line in deck file.'
-                has_sideboard = True
-            elif has_sideboard and matches[1] is not None:
-                sideboard_empty = False
-        if has_sideboard and sideboard_empty:
-            return None, None, err_prefix + 'Sideboard defined, but empty.'
-        # Parse.
-        entry_list = []
-        in_sideboard = False
-        for line in deck_lines:
-            matches = re.match(regex_capture, line).group(2, 3, 4)
-            if matches[0]:
-                in_sideboard = True
-                continue
-            if matches[1] is None:
-                continue
-            add_match_to_entry_list(entry_list, matches, in_sideboard)
-        return entry_list, in_sideboard, ''
+    deck_line_regex = re.compile(r'^\s*(?:(//.*)|(SB:)?\s*(\d+)\s+(\S.*?)\s*|'
+                                 r'(Sideboard)\s*)?$')
+    err_prefix_1 = 'Format 1: Error: '
+    err_prefix_2 = 'Format 2: Error: '
+    entries_1 = {}
+    entries_2 = {}
+    err_line_1 = None
+    err_line_2 = None
+    has_sideboard_1 = False
+    has_sideboard_2 = False
+    sideboard_empty = True
+    more_than_one_sideboard = False
 
     if not os.path.isfile(path):
         print('No deck file:', path)
         return None, None
-    f = open(path, 'r')
-    deck_lines = f.readlines()
-    entry_list, has_sideboard, err_format_1 = try_format_1()
-    if entry_list is None:
-        entry_list, has_sideboard, err_format_2 = try_format_2()
-    if entry_list is None:
-        print(err_format_1)
-        print(err_format_2)
-        return None, None
-    if 0 == len(entry_list):
+    with open(path, 'r') as f:
+        for i, line in enumerate(f, 1):
+            match = deck_line_regex.match(line)
+            if match is None:
+                err_line_1 = err_line_1 or i
+                err_line_2 = err_line_2 or i
+            else:
+                _, sb_marker, count, name, sideboard_line = match.groups()
+                if sideboard_line is not None:
+                    err_line_1 = err_line_1 or i
+                    if has_sideboard_2:
+                        more_than_one_sideboard = True
+                    has_sideboard_2 = True
+                elif count is not None:
+                    if err_line_1 is None:
+                        key = (name, sb_marker is not None)
+                        entries_1[key] = entries_1.get(key, 0) + int(count)
+                        has_sideboard_1 = has_sideboard_1 or key[1]
+                    if sb_marker is not None:
+                        err_line_2 = err_line_2 or i
+                    elif err_line_2 is None:
+                        key = (name, has_sideboard_2)
+                        entries_2[key] = entries_2.get(key, 0) + int(count)
+                        sideboard_empty = sideboard_empty and \
+                            not has_sideboard_2
+            if err_line_1 is not None and err_line_2 is not None:
+                break
+    if err_line_1 is None:
+        entries, has_sideboard = entries_1, has_sideboard_1
+    else:
+        err_format_2 = None
+        if err_line_2 is not None:
+            err_format_2 = 'Deck file malformed on line ' + str(err_line_2)
+        elif more_than_one_sideboard:
+            err_format_2 = 'More than one "Sideboard" line in deck file.'
+        elif has_sideboard_2 and sideboard_empty:
+            err_format_2 = 'Sideboard defined, but empty.'
+        if err_format_2 is not None:
+            print(err_prefix_1 + 'Deck file malformed on line ' +
+                  str(err_line_1))
+            print(err_prefix_2 + err_format_2)
+            return None, None
+        entries, has_sideboard = entries_2, has_sideboard_2
+    if 0 == len(entries):
         print('Deck empty.')
         return None, None
-    return entry_list, has_sideboard
+    return [DeckEntry(name, count, is_sideboard) for (name, is_sideboard),
+            count in entries.items()], has_sideboard
 
 
 def template_is_good(templ):
+    err = template_error(templ)
+    if err:
+        print(err)
+        print('Aborting due to bad card data formatting template.')
+        exit()
+    return True
+
+
+def template_error(templ):
+    try:
+        compile_template(templ)
+    except ValueError as err:
+        return str(err)
+    return None
+
+
+def compile_template(templ):
+    # Split a template once into literal strings and (var name, filter)
+    # pairs, and list the card_records columns these need; the result is
+    # cached per template string.
+    if templ in compiled_templates:
+        return compiled_templates[templ]
 
     def error(msg):
         nonlocal i_marker
-        print('Template error in ' + str(i_marker) + '-th %%: ' + msg)
-        print('Aborting due to bad card data formatting template.')
-        exit()
+        return ValueError('Template error in ' + str(i_marker) + '-th %%: ' +
+                          msg)
 
     legal_names = {
         'name': 0,
@@ -828,16 +2620,20 @@ def template_is_good(templ):
         'foreign_names': 1,
     }
     legal_filters = ['indent', 'comma']
+    parts = []
+    fields = []
     i_end = -1
     i_marker = 0
     while True:
         i_start = templ.find('%', i_end + 1)
         if i_start == -1:
-            return True
+            parts += [templ[i_end + 1:]]
+            break
+        parts += [templ[i_end + 1:i_start]]
         i_marker += 1
         i_end = templ.find('%', i_start + 1)
         if i_end == -1:
-            error('Closing % missing.')
+            raise error('Closing % missing.')
         i_filter = templ.find('|', i_start + 1)
         sep_filter = ''
         var_name = ''
@@ -845,41 +2641,128 @@ def template_is_good(templ):
             var_name = templ[i_start + 1:i_filter]
             sep_filter = templ[i_filter + 1:i_end]
             if sep_filter not in legal_filters:
-                error('Illegal filter name: ' + sep_filter)
+                raise error('Illegal filter name: ' + sep_filter)
         else:
             var_name = templ[i_start + 1:i_end]
         if var_name != '' and var_name not in legal_names:
-            error('Illegal var name: ' + var_name)
-        if sep_filter != '' and legal_names[var_name] != 1:
-            error('Filter ' + sep_filter + ' illegal for ' + var_name + '.')
-
-
-# Parse input.
-argparser, args = parse_args()
-if args.template:
-    template = args.template
-template_is_good(template)
-
-# Execute user command.
-if args.deck_file_name_debug:
-    entry_list, _ = parse_deck_file(args.deck_file_name_debug)
-    if entry_list:
-        for entry in entry_list:
-            print(entry.is_sideboard, entry.count, entry.name)
-else:
-    db = DB()
-    if args.deck_file_name:
-        entry_list, has_sideboard = parse_deck_file(args.deck_file_name)
+            raise error('Illegal var name: ' + var_name)
+        if sep_filter != '' and legal_names.get(var_name) != 1:
+            raise error('Filter ' + sep_filter + ' illegal for ' + var_name +
+                        '.')
+        if var_name == '':
+            parts += ['%']
+        else:
+            parts += [(var_name, sep_filter)]
+            if var_name not in fields:
+                fields += [var_name]
+    # Templates sent to a --serve process could grow this without bound.
+    if len(compiled_templates) >= 256:
+        compiled_templates.clear()
+    compiled_templates[templ] = parts, fields
+    return parts, fields
+
+
+if __name__ == '__main__':
+    # Parse input.
+    argparser, args = parse_args()
+    if args.template:
+        template = args.template
+    template_is_good(template)
+    mtgjson_url = args.mtgjson_url
+
+    # Execute user command.
+    # Plain card lookups are passed on to a --serve process if there is one.
+    response = None
+    if not (args.deck_file_name_debug or args.serve or args.rebuild_db or
+            args.update or args.check_query_plans or args.deck_file_name or
+            args.batch_file_name or args.search_query is not None or
+            args.translate_deck_file_name or args.deck_stats_file_name or
+            args.check_legality or args.resolve_decks_path):
+        if args.server_stats:
+            response = ask_server({'command': 'stats'})
+        elif args.card_translation:
+            response = ask_server({'command': 'translate',
+                                   'name': args.card_translation})
+        elif args.card_name:
+            response = ask_server({'command': 'card', 'name': args.card_name,
+                                   'set': args.card_set, 'template': template,
+                                   'quiet': args.quiet})
+    if args.deck_file_name_debug:
+        entry_list, _ = parse_deck_file(args.deck_file_name_debug)
         if entry_list:
-            import curses
-            import sys
-            sys.stderr = open('error_log', 'w')
-            curses.wrapper(browse_cards, db, entry_list, has_sideboard)
-    elif args.card_translation:
-        get_translated_original_name(db.cursor, args.card_translation)
-    elif args.card_name:
-        [print(line) for line
-         in get_card(db.cursor, args.card_name, args.card_set)]
+            for entry in entry_list:
+                print(entry.is_sideboard, entry.count, entry.name)
+    elif response is not None:
+        if response['ok']:
+            [print(line) for line in response['lines']]
+        else:
+            print('Server error:', response['error'])
+    elif args.server_stats:
+        print('No server running at', server_socket_path())
+    elif args.lookup_name is not None or args.lookup_prefix is not None:
+        if not print_name_lookup(args.lookup_name, args.lookup_prefix):
+            exit(1)
     else:
-        argparser.print_help()
-    db.conn.close()
+        db = DB(args.rebuild_db, args.update, args.build_workers)
+        if args.rebuild_db or args.update:
+            db.print_build_stats()
+        elif args.serve:
+            serve(db)
+        elif args.check_query_plans:
+            if not db.check_query_plans():
+                db.conn.close()
+                exit(1)
+        elif args.deck_file_name:
+            entry_list, has_sideboard = parse_deck_file(args.deck_file_name)
+            if entry_list:
+                import curses
+                import sys
+                sys.stderr = open('error_log', 'w')
+                curses.wrapper(browse_cards, db, entry_list, has_sideboard)
+        elif args.render_cache_stats:
+            stats = RenderCache(db).get_stats()
+            print('%d hits, %d misses, %d bytes cached' %
+                  (stats.get('hits', 0), stats.get('misses', 0),
+                   stats.get('size', 0)))
+        elif args.batch_file_name or args.search_query is not None:
+            import sys
+            separator = args.separator.encode('latin-1', 'backslashreplace')\
+                .decode('unicode_escape')
+            cache = RenderCache(db) if args.render_cache else None
+            if args.search_query is not None:
+                print_cards_search(db.cursor, args.search_query, separator,
+                                   cache)
+            elif args.batch_file_name == '-':
+                print_cards_batch(db.cursor, sys.stdin, separator, cache)
+            else:
+                with open(args.batch_file_name, 'r') as batch_file:
+                    print_cards_batch(db.cursor, batch_file, separator, cache)
+            if cache is not None:
+                cache.close()
+        elif args.translate_deck_file_name:
+            translate_deck_file(db.cursor, args.translate_deck_file_name)
+        elif args.deck_stats_file_name:
+            print_deck_stats(db.cursor, args.deck_stats_file_name)
+        elif args.resolve_decks_path:
+            resolve_decks(db, [args.resolve_decks_path])
+        elif args.check_legality:
+            if len(args.check_legality) < 2:
+                argparser.error('--check-legality needs a format and at least '
+                                'one deck file or directory')
+            if not check_legality(db, args.check_legality[0],
+                                  args.check_legality[1:]):
+                db.conn.close()
+                exit(1)
+        elif args.card_translation:
+            [print(line) for line
+             in get_translated_original_name(db.cursor, args.card_translation)]
+        elif args.card_name:
+            cache = RenderCache(db) if args.render_cache else None
+            [print(line) for line
+             in get_card(db.cursor, args.card_name, args.card_set,
+                         cache=cache)]
+            if cache is not None:
+                cache.close()
+        else:
+            argparser.print_help()
+        db.conn.close()
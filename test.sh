@@ -36,6 +36,7 @@ mkdir -p "$generated_files_dir"
 ./mtgtool.py -f '%names|%' > "$generated_files_dir"/template_fail_4
 ./mtgtool.py -f '%names|foo%' > "$generated_files_dir"/template_fail_5
 ./mtgtool.py -f '%name|comma%' > "$generated_files_dir"/template_fail_6
+./mtgtool.py --search '' > "$generated_files_dir"/search_empty
 ./mtgtool.py -c 'Raging Goblin' -q -f 'foo' > "$generated_files_dir"/template_success_1
 ./mtgtool.py -c 'Raging Goblin' -q -f 'foo%%' > "$generated_files_dir"/template_success_2
 ./mtgtool.py -c 'Raging Goblin' -q -f 'foo%%%name%%%' > "$generated_files_dir"/template_success_3
@@ -56,6 +57,101 @@ mkdir -p "$generated_files_dir"
 ./mtgtool.py --test-parser "$expected_files_dir"/deckfiles/testdeck_bad_9 > "$generated_files_dir"/testdeck_bad_9
 ./mtgtool.py --test-parser "$expected_files_dir"/deckfiles/testdeck_bad_10 > "$generated_files_dir"/testdeck_bad_10
 
+# Modes needing particular cards run against a DB built from a card data
+# fixture.
+mtgjson_dir="$PWD/$expected_files_dir"/mtgjson
+cards_home="$generated_files_dir"/cards_home
+(cd "$mtgjson_dir/cards" && python3 -m zipfile -c \
+  "$OLDPWD/$generated_files_dir/cards.zip" AllSets-x.json)
+HOME="$cards_home" ./mtgtool.py -q \
+  --mtgjson-url "file://$PWD/$generated_files_dir/cards.zip" > /dev/null
+HOME="$cards_home" ./mtgtool.py -b "$expected_files_dir"/batchfiles/batch_1 \
+  -f '%name%: %rarity% (%sets|comma%)' --separator='--\n' \
+  > "$generated_files_dir"/batch_1
+printf 'Black Lotus\nMountain\tM10\n' | HOME="$cards_home" ./mtgtool.py -b - \
+  -q -f '%name% %oracle_text%' --separator='' > "$generated_files_dir"/batch_stdin
+HOME="$cards_home" ./mtgtool.py -c 'aether vial' -q -f '%name%' \
+  > "$generated_files_dir"/AetherVialInsensitive
+HOME="$cards_home" ./mtgtool.py -c 'JOTUN grunt' -q -f '%name%' \
+  > "$generated_files_dir"/JotunGruntInsensitive
+HOME="$cards_home" ./mtgtool.py -c 'Aether Vail' \
+  > "$generated_files_dir"/AetherVailSuggestions
+HOME="$cards_home" ./mtgtool.py -c 'Xyzzy' > "$generated_files_dir"/XyzzyUnknown
+HOME="$cards_home" ./mtgtool.py -t 'atherphiole' \
+  > "$generated_files_dir"/AtherphioleInsensitive
+HOME="$cards_home" ./mtgtool.py --search 'color:Red type:Instant cmc<=2 damage' \
+  -f '%name%: %flavor%' --separator='' > "$generated_files_dir"/search_filters
+HOME="$cards_home" ./mtgtool.py --search 'legal:legacy rarity:"Common"' \
+  -f '%name%' --separator='' > "$generated_files_dir"/search_legal
+HOME="$cards_home" ./mtgtool.py --search 'draw* cmc>=2' -f '%name%' \
+  --separator='' > "$generated_files_dir"/search_prefix
+HOME="$cards_home" ./mtgtool.py --search '"any target" NOT gain' -f '%name%' \
+  --separator='' > "$generated_files_dir"/search_not
+HOME="$cards_home" ./mtgtool.py --search 'subtype:Dragon' \
+  > "$generated_files_dir"/search_none
+HOME="$cards_home" ./mtgtool.py --search 'cmc:x' \
+  > "$generated_files_dir"/search_bad_cmc
+HOME="$cards_home" ./mtgtool.py --search 'type<Instant' \
+  > "$generated_files_dir"/search_bad_operator
+HOME="$cards_home" ./mtgtool.py \
+  --translate-deck "$expected_files_dir"/deckfiles/german_deck \
+  > "$generated_files_dir"/translate_deck \
+  2> "$generated_files_dir"/translate_deck_warnings
+HOME="$cards_home" ./mtgtool.py \
+  --deck-stats "$expected_files_dir"/deckfiles/stats_deck \
+  > "$generated_files_dir"/deck_stats
+for format in Legacy Vintage Commander Modern Unknown; do
+  HOME="$cards_home" ./mtgtool.py --check-legality "$format" \
+    "$expected_files_dir"/legality_decks > "$generated_files_dir/legality_$format"
+  echo "exit status: $?" >> "$generated_files_dir/legality_$format"
+done
+HOME="$cards_home" ./mtgtool.py --check-legality legacy \
+  "$expected_files_dir"/legality_decks/legal > "$generated_files_dir"/legality_legal
+echo "exit status: $?" >> "$generated_files_dir"/legality_legal
+HOME="$cards_home" ./mtgtool.py \
+  --resolve-decks "$expected_files_dir"/legality_decks \
+  > "$generated_files_dir"/resolve_decks
+name_lookups()
+{
+  for name in 'lightning bolt' 'AETHER VIAL' 'Soul' 'Xyzzy'; do
+    HOME="$cards_home" ./mtgtool.py --lookup "$name"
+    echo "exit status: $?"
+  done
+  for prefix in 'soul' 'Research ' 'Xyzzy'; do
+    HOME="$cards_home" ./mtgtool.py --lookup-prefix "$prefix"
+    echo "exit status: $?"
+  done
+}
+name_lookups > "$generated_files_dir"/name_lookups
+# Without the name index, the DB answers the first lookup and writes it anew.
+rm "$cards_home"/.mtgtool/names.idx
+name_lookups > "$generated_files_dir"/name_lookups_without_index
+diff_test "$generated_files_dir"/name_lookups \
+  "$generated_files_dir"/name_lookups_without_index
+
+# Lookups passed on to a --serve process must be answered as in-process ones.
+fixture_lookups()
+{
+  HOME="$cards_home" ./mtgtool.py -c 'Lightning Bolt'
+  HOME="$cards_home" ./mtgtool.py -c 'Lightning Bolt' -p LEA -q -f '%name%'
+  HOME="$cards_home" ./mtgtool.py -c 'Research // Development'
+  HOME="$cards_home" ./mtgtool.py -c 'Blak Lotis'
+  HOME="$cards_home" ./mtgtool.py -t 'Seelenfeuer'
+}
+fixture_lookups > "$generated_files_dir"/lookups_in_process
+HOME="$cards_home" ./mtgtool.py -q --serve &
+server_pid=$!
+while [ ! -S "$cards_home"/.mtgtool/socket ]; do
+  sleep 0.1
+done
+fixture_lookups > "$generated_files_dir"/lookups_served
+HOME="$cards_home" ./mtgtool.py --server-stats | cut -d, -f1 \
+  > "$generated_files_dir"/server_stats
+kill "$server_pid"
+wait "$server_pid"
+diff_test "$generated_files_dir"/lookups_in_process \
+  "$generated_files_dir"/lookups_served
+
 # Compare metadata files.
 for file in "$expected_files_dir"/*; do
   if [ ! -d "$file" ]; then
@@ -70,3 +166,35 @@ for file in "$expected_files_dir"/*; do
     fi
   fi
 done
+
+# Update a DB to a card data release without a set sharing a card with a kept
+# set, and with a new one of the same release date as a kept set, but before
+# it in the card data, and compare it to a DB built from that release.
+for release in update_before update_after; do
+  (cd "$mtgjson_dir/$release" && python3 -m zipfile -c \
+    "$OLDPWD/$generated_files_dir/$release.zip" AllSets-x.json)
+done
+HOME="$generated_files_dir"/updated_home ./mtgtool.py -q \
+  --mtgjson-url "file://$PWD/$generated_files_dir/update_before.zip" \
+  > /dev/null
+HOME="$generated_files_dir"/updated_home ./mtgtool.py -q --update \
+  --mtgjson-url "file://$PWD/$generated_files_dir/update_after.zip" \
+  > /dev/null
+HOME="$generated_files_dir"/built_home ./mtgtool.py -q \
+  --mtgjson-url "file://$PWD/$generated_files_dir/update_after.zip" \
+  > /dev/null
+for home in updated_home built_home; do
+  HOME="$generated_files_dir/$home" ./mtgtool.py -q -c 'Shared Elf' \
+    -f '%name% %sets|comma% %flavor%' > "$generated_files_dir/shared_elf_$home"
+done
+diff_test "$generated_files_dir"/shared_elf_built_home \
+  "$generated_files_dir"/shared_elf_updated_home
+
+# All card lookup queries must use indexes on a DB built from card data.
+printf "== --check-query-plans test ==\n"
+if HOME="$generated_files_dir"/built_home ./mtgtool.py --check-query-plans \
+    > /dev/null; then
+  echo "== test SUCCESS =="
+else
+  echo "== test FAILURE =="
+fi